@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+''' Build the whole family of Orange datasets from the batch feature files in
+    one streaming pass, instead of one csv2orange run per dataset:
+
+        dataset_batches_N_only.tab     one per batch
+        dataset_batches_all_notN.tab   leave one batch out
+        dataset_batches_all.tab        every batch
+        dataset_batches.npz            X, y, batch, person, frame, classes
+
+    Extra leave-out sets are added with -x, e.g. -x 89 for all_not89.
+
+        python buildDatasets.py -l window_vent_data2.csv -x 89
+'''
+import os
+import sys
+import shutil
+import tempfile
+import zipfile
+from itertools import islice
+from optparse import OptionParser
+
+import numpy as np
+
+# the batch layout is defined once, in src/features.py
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'src'))
+from features import PEOPLE_PER_BATCH
+
+CHUNK = 1024 # lines labelled at a time
+
+def loadLabels(path, offset=3):
+    ''' Label matrix (person x frame) of class indices, -1 where a person has
+        no label for a frame, and the class names. Rows of the label csv are
+        people, the first offset columns aren't labels. '''
+    people = [line.split(',')[offset:] for line in open(path).read().splitlines()]
+    classes = sorted(set(l for p in people for l in p if l))
+    index = dict((c, i) for i, c in enumerate(classes))
+    codes = -np.ones((len(people), max(len(p) for p in people)), dtype=np.int16)
+    for i, p in enumerate(people):
+        codes[i,:len(p)] = [index.get(l, -1) for l in p]
+    return codes, classes
+
+def datasetGroups(batches, exclude=()):
+    ''' {dataset name: batches it holds} '''
+    groups = {'all': set(batches)}
+    for b in batches:
+        groups['%d_only' % b] = set([b])
+        groups['all_not%d' % b] = set(batches) - set([b])
+    for ex in exclude:
+        groups['all_not' + ex] = set(batches) - set(int(c) for c in ex)
+    return groups
+
+class _RawArray:
+    ''' Column of the .npz, appended to a raw temporary file and turned into
+        a .npy file once its final length is known. '''
+    def __init__(self, tmpdir, name, dtype, shape=()):
+        self.name, self.dtype, self.shape = name, np.dtype(dtype), tuple(shape)
+        self.path = os.path.join(tmpdir, name + '.raw')
+        self.file = open(self.path, 'wb')
+        self.n = 0
+
+    def append(self, values):
+        values = np.asarray(values, dtype=self.dtype)
+        self.file.write(values.tostring())
+        self.n += len(values)
+
+    def toNpy(self):
+        self.file.close()
+        npy = self.path[:-4] + '.npy'
+        f = open(npy, 'wb')
+        np.lib.format.write_array_header_1_0(f, {'descr': np.lib.format.dtype_to_descr(self.dtype),
+                                                  'fortran_order': False,
+                                                  'shape': (self.n,) + self.shape})
+        raw = open(self.path, 'rb')
+        shutil.copyfileobj(raw, f)
+        raw.close()
+        f.close()
+        return npy
+
+def buildDatasets(labelPath, batches, pattern='batch%d_features.dat', outDir='.', labelOffset=3,
+                  exclude=(), names=None, peopleNums=PEOPLE_PER_BATCH, npz='dataset_batches.npz'):
+    ''' Stream every batch file once, join each row with its label and
+        append it to every dataset holding its batch. Row r of batch b is face
+        f of frame r // peopleNums[b-1], whose person number is f plus the
+        people of the batches before b. Returns {dataset name: rows}. '''
+    codes, classes = loadLabels(labelPath, labelOffset)
+    classNames = np.array(classes + ['?'])
+
+    first = open(pattern % batches[0]).readline().split()
+    nFeatures = len(first) - 1
+    if names is None:
+        names = [str(i) for i in range(nFeatures)]
+    integral = all(t.strip().isdigit() for t in first[1:])
+
+    groups = datasetGroups(batches, exclude)
+    files = {}
+    for name in groups:
+        fw = open(os.path.join(outDir, 'dataset_batches_%s.tab' % name), 'w')
+        fw.write('\t'.join(names) + '\tclass_view\n')
+        fw.write('c\t'*nFeatures + 'd\n')
+        fw.write('\t'*nFeatures + 'class\n')
+        files[name] = fw
+    counts = dict((name, 0) for name in groups)
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        columns = [_RawArray(tmpdir, 'X', np.uint16 if integral else np.float32, (nFeatures,)),
+                   _RawArray(tmpdir, 'y', np.int16),
+                   _RawArray(tmpdir, 'batch', np.uint8),
+                   _RawArray(tmpdir, 'person', np.uint16),
+                   _RawArray(tmpdir, 'frame', np.uint32)]
+
+        for b in batches:
+            targets = [files[name] for name in sorted(groups) if b in groups[name]]
+            basePeople = sum(peopleNums[:b-1])
+            f = open(pattern % b)
+            row = 0
+            while True:
+                lines = list(islice(f, CHUNK))
+                if not lines:
+                    break
+                split = [line.split() for line in lines]
+                values = ['\t'.join(s[1:]) for s in split]
+
+                face = np.array([int(s[0]) for s in split])
+                frame = np.arange(row, row + len(lines)) // peopleNums[b-1]
+                person = face - 1 + basePeople
+                known = (person < codes.shape[0]) & (frame < codes.shape[1])
+                y = -np.ones(len(lines), dtype=np.int16)
+                y[known] = codes[person[known], frame[known]]
+                lbls = classNames[y]
+
+                text = ''.join([v + '\t' + l + '\n' for v, l in zip(values, lbls)])
+                for fw in targets:
+                    fw.write(text)
+                for name in groups:
+                    if b in groups[name]:
+                        counts[name] += len(lines)
+
+                X = np.fromstring(' '.join(values), sep=' ')
+                columns[0].append(X.reshape(len(lines), nFeatures))
+                columns[1].append(y)
+                columns[2].append(np.repeat(b, len(lines)))
+                columns[3].append(person + 1)
+                columns[4].append(frame)
+                row += len(lines)
+            f.close()
+
+        if npz:
+            np.save(os.path.join(tmpdir, 'classes.npy'), np.array(classes))
+            z = zipfile.ZipFile(os.path.join(outDir, npz), 'w', zipfile.ZIP_STORED, allowZip64=True)
+            for col in columns:
+                z.write(col.toNpy(), col.name + '.npy')
+            z.write(os.path.join(tmpdir, 'classes.npy'), 'classes.npy')
+            z.close()
+    finally:
+        for fw in files.values():
+            fw.close()
+        shutil.rmtree(tmpdir)
+
+    return counts
+
+def main(args):
+    parser = OptionParser(usage="%prog [options] [BATCH ...]")
+    parser.add_option("-l", "--labels", default="window_vent_data2.csv", help="label csv, one row per person")
+    parser.add_option("--label-offset", type="int", default=3, help="leading non-label columns of the label csv")
+    parser.add_option("-p", "--pattern", default="batch%d_features.dat", help="batch feature file name pattern")
+    parser.add_option("-o", "--output", default=".", help="output directory")
+    parser.add_option("-x", "--exclude", action="append", default=[], help="extra leave-out set, e.g. 89")
+    parser.add_option("--names", default=None, help="comma separated feature names (default 0..n-1)")
+    parser.add_option("--npz", default="dataset_batches.npz", help="compact dataset file name, empty to skip")
+    options, args = parser.parse_args(args)
+
+    batches = [int(b) for b in args] or [b+1 for b in range(len(PEOPLE_PER_BATCH))
+                                         if os.path.exists(options.pattern % (b+1))]
+    names = options.names.split(',') if options.names else None
+
+    counts = buildDatasets(options.labels, batches, options.pattern, options.output, options.label_offset,
+                           options.exclude, names, npz=options.npz)
+    for name in sorted(counts):
+        print 'dataset_batches_%s.tab: %d rows' % (name, counts[name])
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,359 @@
+#!/usr/bin/env python
+''' Headless benchmarks over the bundled depth fixtures (It_depth.dat,
+    It2_depth.dat, rect.dat) and synthetic multi-person depth frames.
+
+    python benchmark.py                         run and print
+    python benchmark.py --save baseline.json    also save the results
+    python benchmark.py --check baseline.json   fail if anything regressed
+
+    --check allows --tolerance plus the measured noise (interquartile
+    range over median) of either run, in both the best and the median time,
+    and reruns anything over that once before reporting it.
+
+    Every benchmark runs in a fresh process so that its peak memory can be
+    reported. Benchmarks whose dependencies (ROS messages for the Gaze and
+    point cloud code) are not importable are reported as skipped.
+'''
+import os
+import sys
+import json
+import time
+import pickle
+import random
+import resource
+from multiprocessing import Pool
+from optparse import OptionParser
+
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+def loadFixtures():
+    fixtures = []
+    for name in ['It_depth.dat', 'It2_depth.dat', 'rect.dat']:
+        f = open(os.path.join(HERE, name), 'rb')
+        fixtures.append(pickle.load(f))
+        f.close()
+    return fixtures
+
+def syntheticFrame(nPeople, seed=0, shape=(480, 640)):
+    ''' A Kinect-like uint16 depth frame (mm) of nPeople standing side by side,
+        with zero-depth shadows at their edges and a patch of far background
+        (dxySegment scales depth by the frame maximum). '''
+    rng = np.random.RandomState(seed)
+    rows, cols = shape
+    d = np.zeros(shape, dtype=np.float64)
+
+    Y, X = np.mgrid[:rows,:cols]
+    centres = (np.arange(nPeople) + 0.5) * cols / float(nPeople)
+    for c in centres:
+        z = rng.uniform(1800, 2400)
+        scale = 2100.0 / z
+        top = rng.randint(100, 140)
+        head = ((X - c) / (28*scale))**2 + ((Y - top - 35*scale) / (35*scale))**2 < 1
+        body = (np.abs(X - c) < 60*scale) & (Y > top + 65*scale)
+        person = head | body
+        d[person] = z + 40*((X[person] - c) / (28*scale))**2 + 5*rng.randn(person.sum())
+        shadow = (np.abs(X - c - 62*scale) < 4) & (Y > top)
+        d[shadow] = 0
+    d[250:280,:8] = 7000 + 50*rng.randn(30, 8)
+
+    return np.round(d).astype(np.uint16)
+
+def timeit(fn, minTime=0.5, minRepeat=10):
+    fn() # warm up caches and lazy imports
+    times = []
+    total = 0.0
+    while total < minTime or len(times) < minRepeat:
+        st = time.time()
+        fn()
+        times.append(time.time() - st)
+        total += times[-1]
+    return times
+
+# Each benchmark returns (function to time, items processed per call, unit)
+
+def bench_lk():
+    from lk import lk
+    im1, im2, rect = loadFixtures()
+    return (lambda: lk(im1, im2, rect)), 1, 'faces'
+
+def bench_lkPyramid():
+    from lk import lkPyramid
+    im1, im2, rect = loadFixtures()
+    return (lambda: lkPyramid(im1, im2, [rect])), 1, 'faces'
+
+def _segment(fn, nPeople, skip, **kwargs):
+    frames = [syntheticFrame(nPeople, seed) for seed in range(2)]
+    r, seeds = fn(frames[0], nClusters=nPeople, skip=skip, **kwargs)[:2]
+    state = {'i': 0}
+    def run():
+        state['i'] += 1
+        fn(frames[state['i'] % 2], seeds=seeds, skip=skip, **kwargs)
+    return run, 1, 'frames'
+
+def _dxySegment(nPeople, skip):
+    def bench():
+        from dxySegment import dxySegment
+        return _segment(dxySegment, nPeople, skip)
+    return bench
+
+def _dxySegmentSparse(nPeople, engine):
+    def bench():
+        from dxySegment import dxySegmentSparse
+        return _segment(dxySegmentSparse, nPeople, 1, engine=engine)
+    return bench
+
+def _clusterLabels(nPeople):
+    from dxySegment import dxySegmentSparse
+    rects, centroids, labels = dxySegmentSparse(syntheticFrame(nPeople), nPeople, skip=1)
+    rows, cols = np.nonzero(labels >= 0)
+    return rows, cols, labels[rows, cols], len(centroids)
+
+def _loopBoxes(rows, cols, codes, nClusters, face_height=50):
+    """ The per-cluster mask loop clusterBoxes replaced, for comparison """
+    rects = []
+    for k in range(nClusters):
+        X_cluster = rows[codes==k]
+        if len(X_cluster) == 0:
+            continue
+        Y_cluster = cols[codes==k]
+        xmin = np.min(X_cluster)
+        Y_face = Y_cluster[X_cluster < xmin+face_height]
+        rects.append([np.min(Y_face)-1, xmin, np.max(Y_face)+1, xmin+face_height])
+    return rects
+
+def _clusterBoxes(nPeople, loop=False):
+    def bench():
+        from dxySegment import _boxes
+        rows, cols, codes, nClusters = _clusterLabels(nPeople)
+        fn = _loopBoxes if loop else _boxes
+        return (lambda: fn(rows, cols, codes, nClusters)), 1, 'frames'
+    return bench
+
+def _faceBox():
+    im1, im2, rect = loadFixtures()
+    x1, y1, x2, y2 = [int(c) for c in rect]
+    u, v = np.mgrid[y1-40:y2+40, x1-10:x2+10]
+    d = im1[y1-40:y2+40, x1-10:x2+10].astype(np.float64)
+    valid = d != 0
+    return u[valid], v[valid], d[valid]
+
+class _Rays:
+    def __init__(self):
+        from projection import rayTable
+        self.rays = rayTable()
+
+def bench_makeCloud_correct():
+    from gaze import Gaze
+    u, v, d = _faceBox()
+    return (lambda: Gaze.makeCloud_correct.im_func(_Rays(), u, v, d)), len(d), 'points'
+
+def bench_makeCloud():
+    from gaze import Gaze
+    u, v, d = _faceBox()
+    return (lambda: Gaze.makeCloud.im_func(None, u, v, d)), len(d), 'points'
+
+def bench_RayTable_project():
+    from projection import rayTable
+    im1, im2, rect = loadFixtures()
+    x1, y1, x2, y2 = [int(c) for c in rect]
+    box = (x1-10, y1-40, x2+10, y2+40)
+    rays = rayTable()
+    out = np.empty((box[3]-box[1], box[2]-box[0], 3), dtype=np.float32)
+    return (lambda: rays.project(im1, box, out)), out.shape[0]*out.shape[1], 'points'
+
+def _cloudPoints(n=20000):
+    return np.random.RandomState(0).rand(n, 3).astype(np.float32)
+
+def bench_create_cloud_xyz32():
+    from point_cloud import create_cloud_xyz32
+    pts = [tuple(p) for p in _cloudPoints()]
+    return (lambda: create_cloud_xyz32(None, pts)), len(pts), 'points'
+
+def bench_create_cloud_xyz32_array():
+    from point_cloud import create_cloud_xyz32_array
+    pts = _cloudPoints()
+    return (lambda: create_cloud_xyz32_array(None, pts)), len(pts), 'points'
+
+def dxySegmentBoxes(frame, nPeople):
+    from dxySegment import dxySegmentSparse
+    return sorted(dxySegmentSparse(frame, nClusters=nPeople, skip=1, engine='histogram')[0])
+
+def _descriptors(n=5):
+    return np.random.RandomState(0).randint(0, 4000, size=(n, 400)).astype(np.uint16)
+
+def bench_faceDescriptors():
+    from features import faceDescriptors
+    frame = syntheticFrame(5)
+    faces = dxySegmentBoxes(frame, 5)
+    out = np.empty((len(faces), 400), dtype=np.uint16)
+    return (lambda: faceDescriptors(frame, faces, out=out)), len(faces), 'faces'
+
+def bench_featureRow():
+    from features import featureRow
+    descs = _descriptors()
+    out = open(os.devnull, 'w')
+    def run():
+        for faceNum, desc in enumerate(descs):
+            out.write(featureRow(faceNum+1, desc))
+    return run, len(descs), 'faces'
+
+def bench_FeatureWriter():
+    from featurestore import FeatureWriter
+    descs = _descriptors()
+    writer = FeatureWriter(os.devnull)
+    def run():
+        for faceNum, desc in enumerate(descs):
+            writer.write(faceNum+1, desc)
+    return run, len(descs), 'faces'
+
+def bench_GazeClassifier():
+    import tempfile
+    from classifier import saveModel, GazeClassifier
+    rng = np.random.RandomState(0)
+    f = tempfile.NamedTemporaryFile(suffix='.gzm')
+    saveModel(f.name, rng.randn(400, 6), rng.randn(6), ['eachother', 'floor', 'left', 'robot', 'vent', 'window'])
+    model = GazeClassifier(f.name)
+    descs = _descriptors()
+    return (lambda: (f, model.labels(descs))), len(descs), 'faces'
+
+def bench_Codebook():
+    import tempfile
+    from codebook import saveCodebook, Codebook
+    rng = np.random.RandomState(0)
+    f = tempfile.NamedTemporaryFile(suffix='.gzp')
+    saveCodebook(f.name, rng.rand(400) * 2000, rng.randn(400, 20))
+    codebook = Codebook(f.name)
+    descs = _descriptors()
+    out = np.empty((len(descs), codebook.k), dtype=np.float32)
+    return (lambda: (f, codebook.project(descs, out=out))), len(descs), 'faces'
+
+BENCHMARKS = [('lk', bench_lk),
+              ('lkPyramid', bench_lkPyramid)]
+for nPeople in [3, 5]:
+    for skip in [1, 4, 10]:
+        BENCHMARKS.append(('dxySegment n=%d skip=%d' % (nPeople, skip), _dxySegment(nPeople, skip)))
+    for engine in ['kmeans2', 'histogram']:
+        BENCHMARKS.append(('dxySegmentSparse n=%d %s' % (nPeople, engine), _dxySegmentSparse(nPeople, engine)))
+    BENCHMARKS.append(('clusterBoxes n=%d' % nPeople, _clusterBoxes(nPeople)))
+    BENCHMARKS.append(('clusterBoxes loop n=%d' % nPeople, _clusterBoxes(nPeople, loop=True)))
+BENCHMARKS += [('makeCloud_correct', bench_makeCloud_correct),
+               ('makeCloud', bench_makeCloud),
+               ('RayTable.project', bench_RayTable_project),
+               ('create_cloud_xyz32', bench_create_cloud_xyz32),
+               ('create_cloud_xyz32_array', bench_create_cloud_xyz32_array),
+               ('faceDescriptors', bench_faceDescriptors),
+               ('featureRow', bench_featureRow),
+               ('FeatureWriter', bench_FeatureWriter),
+               ('GazeClassifier', bench_GazeClassifier),
+               ('Codebook.project', bench_Codebook)]
+
+def runBenchmark(index):
+    name, bench = BENCHMARKS[index]
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kmeans2 seeding (and the synthetic frames' noise) draw from the global
+    # generators, seed them so every run segments the same frames the same way
+    np.random.seed(0)
+    random.seed(0)
+    try:
+        fn, items, unit = bench()
+    except ImportError, e:
+        return {'name': name, 'skipped': str(e)}
+    times = timeit(fn)
+    best = min(times)
+    return {'name': name,
+            'best_s': best,
+            'median_s': float(np.median(times)),
+            'q1_s': float(np.percentile(times, 25)),
+            'q3_s': float(np.percentile(times, 75)),
+            'repeat': len(times),
+            'throughput': items / best,
+            'unit': unit + '/s',
+            'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss}
+
+def runAll(pattern=None, names=None):
+    results = []
+    for i, (name, bench) in enumerate(BENCHMARKS):
+        if pattern and pattern not in name:
+            continue
+        if names is not None and name not in names:
+            continue
+        pool = Pool(1)
+        try:
+            results.append(pool.apply(runBenchmark, (i,)))
+        finally:
+            pool.close()
+            pool.join()
+    return results
+
+def noise(r):
+    ''' Spread of a benchmark's times, the interquartile range over the
+        median (0 for results saved without quartiles). '''
+    if 'q1_s' not in r:
+        return 0.0
+    return (r['q3_s'] - r['q1_s']) / r['median_s']
+
+def compare(results, baseline, tolerance):
+    ''' Names of benchmarks that are slower than in baseline by more than
+        tolerance (a fraction) plus the noise of the noisier of the
+        two runs, in both their best and their median time. '''
+    base = dict((r['name'], r) for r in baseline if 'best_s' in r)
+    regressions = []
+    for r in results:
+        if 'best_s' in r and r['name'] in base:
+            b = base[r['name']]
+            limit = 1 + tolerance + max(noise(r), noise(b))
+            if r['best_s'] > b['best_s'] * limit and r['median_s'] > b['median_s'] * limit:
+                regressions.append(r['name'])
+    return regressions
+
+def merge(results, rerun):
+    ''' results with every rerun benchmark's times replaced by the faster
+        of its two runs. '''
+    faster = dict((r['name'], r) for r in rerun if 'best_s' in r)
+    merged = []
+    for r in results:
+        if r['name'] in faster and faster[r['name']]['median_s'] < r['median_s']:
+            r = faster[r['name']]
+        merged.append(r)
+    return merged
+
+def main(args):
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("-k", dest="pattern", default=None, help="only run benchmarks whose name contains this")
+    parser.add_option("--save", default=None, help="write the results to this JSON file")
+    parser.add_option("--check", default=None, help="compare against this JSON baseline, exit 1 on regressions")
+    parser.add_option("--tolerance", type="float", default=0.25, help="allowed slowdown for --check (fraction)")
+    options, args = parser.parse_args(args)
+
+    results = runAll(options.pattern)
+    print '%-32s %10s %10s %16s %10s' % ('benchmark', 'best ms', 'median ms', 'throughput', 'peak MB')
+    for r in results:
+        if 'skipped' in r:
+            print '%-32s skipped (%s)' % (r['name'], r['skipped'])
+        else:
+            print '%-32s %10.3f %10.3f %10.0f %-5s %10.1f' % (r['name'], 1000*r['best_s'], 1000*r['median_s'],
+                                                             r['throughput'], r['unit'].split('/')[0], r['peak_rss_kb']/1024.0)
+
+    if options.save:
+        f = open(options.save, 'w')
+        json.dump(results, f, indent=2)
+        f.close()
+
+    if options.check:
+        baseline = json.load(open(options.check))
+        regressions = compare(results, baseline, options.tolerance)
+        if regressions:
+            """ A one-off slow run (another process, frequency scaling) is not a regression """
+            print 'rechecking', ', '.join(regressions)
+            results = merge(results, runAll(names=regressions))
+            regressions = compare(results, baseline, options.tolerance)
+        if regressions:
+            print 'REGRESSED:', ', '.join(regressions)
+            return 1
+        print 'no regressions against', options.check
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+''' Linear gaze target classifier on the face depth descriptors.
+
+    A multinomial logistic regression, trained offline on the Orange
+    datasets built by buildDatasets.py and applied to every face of a frame
+    with one matrix multiply:
+
+        python classifier.py -o gaze_model.gzm dataset_batches_all_not89.tab
+        python classifier.py -o gaze_model.gzm --test dataset_batches_8_only.tab dataset_batches_all_not89.tab
+        python classifier.py -o gaze_model.gzm -c codebook.gzp dataset_batches_all.tab
+
+    With a codebook (codebook.py) the model is trained on, and expects, PCA
+    codes instead of raw descriptors.
+
+    A model file is a 16 byte header, the class names (16 bytes each) and a
+    float32 (features + 1, classes) weight matrix whose last row is the bias.
+    Feature standardization is folded into the weights, so raw uint16
+    descriptors go straight in. The weights are memory mapped on load.
+'''
+import sys
+import struct
+from optparse import OptionParser
+
+import numpy as np
+from scipy.optimize import fmin_l_bfgs_b
+
+MAGIC = 'GZCM'
+VERSION = 1
+_HEADER = struct.Struct('<4sHHH6x') # magic, version, number of features, number of classes
+HEADER_SIZE = _HEADER.size
+NAME_SIZE = 16
+
+def loadTab(path):
+    ''' Descriptors (float32, one row per example) and class labels of an
+        Orange .tab dataset. Examples without a label are skipped. '''
+    f = open(path)
+    nFeatures = len(f.readline().rstrip('\n').split('\t')) - 1
+    f.readline(); f.readline()
+    features, labels = [], []
+    for line in f:
+        tokens = line.rstrip('\n').split('\t')
+        if tokens[nFeatures] in ('', '?'):
+            continue
+        features.append(' '.join(tokens[:nFeatures]))
+        labels.append(tokens[nFeatures])
+    f.close()
+    X = np.fromstring(' '.join(features), dtype=np.float32, sep=' ').reshape(len(features), nFeatures)
+    return X, labels
+
+def _softmax(scores):
+    scores = scores - scores.max(axis=1)[:,np.newaxis]
+    p = np.exp(scores)
+    return p / p.sum(axis=1)[:,np.newaxis]
+
+def train(X, y, nClasses, l2=1.0, balanced=True, maxIter=500):
+    ''' Fit W, b of a multinomial logistic regression with an L2 penalty on
+        standardized X, class indices y. With balanced every class weighs
+        as much as any other in the loss, however many examples it has.
+        Returns W (features, classes) and b (classes) for raw X. '''
+    X = np.asarray(X, dtype=np.float64)
+    mean = X.mean(axis=0)
+    std = X.std(axis=0)
+    std[std == 0] = 1.0
+    Z = (X - mean) / std
+    n, d = Z.shape
+
+    T = np.zeros((n, nClasses))
+    T[np.arange(n), y] = 1.0
+    counts = np.bincount(y, minlength=nClasses).astype(np.float64)
+    if balanced:
+        w = (n / (nClasses * np.maximum(counts, 1)))[y]
+    else:
+        w = np.ones(n)
+    w /= w.sum()
+
+    def loss(theta):
+        W = theta[:d*nClasses].reshape(d, nClasses)
+        b = theta[d*nClasses:]
+        P = _softmax(np.dot(Z, W) + b)
+        nll = -np.sum(w * np.log(np.maximum(P[np.arange(n), y], 1e-300)))
+        G = (P - T) * w[:,np.newaxis]
+        gW = np.dot(Z.T, G) + l2 / n * W
+        gb = G.sum(axis=0)
+        return nll + 0.5 * l2 / n * np.sum(W * W), np.concatenate((gW.ravel(), gb))
+
+    theta, f, info = fmin_l_bfgs_b(loss, np.zeros(d*nClasses + nClasses), maxiter=maxIter)
+    W = theta[:d*nClasses].reshape(d, nClasses)
+    b = theta[d*nClasses:]
+
+    """ Fold the standardization into the weights """
+    W = W / std[:,np.newaxis]
+    b = b - np.dot(mean, W)
+    return W, b
+
+def saveModel(path, W, b, classes):
+    d, nClasses = W.shape
+    f = open(path, 'wb')
+    f.write(_HEADER.pack(MAGIC, VERSION, d, nClasses))
+    f.write(np.array(classes, dtype='S%d' % NAME_SIZE).tostring())
+    f.write(np.vstack((W, b)).astype('<f4').tostring())
+    f.close()
+
+class GazeClassifier:
+    ''' A model file, loaded once. predict() labels every descriptor of a
+        frame in one go. '''
+    def __init__(self, path):
+        f = open(path, 'rb')
+        try:
+            magic, version, d, nClasses = _HEADER.unpack(f.read(HEADER_SIZE))
+            if magic != MAGIC or version != VERSION:
+                raise IOError('%s is not a version %d gaze model' % (path, VERSION))
+            self.classes = np.fromstring(f.read(NAME_SIZE * nClasses), dtype='S%d' % NAME_SIZE)
+        finally:
+            f.close()
+        weights = np.memmap(path, dtype='<f4', mode='r', offset=HEADER_SIZE + NAME_SIZE * nClasses,
+                            shape=(d + 1, nClasses))
+        self.W, self.b = weights[:d], weights[d]
+        self.nFeatures = d
+
+    def scores(self, X):
+        ''' (faces, classes) scores of a (faces, features) descriptor matrix. '''
+        return np.dot(np.asarray(X, dtype=np.float32), self.W) + self.b
+
+    def predict(self, X):
+        ''' Class index of every row of X. '''
+        if len(X) == 0:
+            return np.zeros(0, dtype=np.intp)
+        return self.scores(X).argmax(axis=1)
+
+    def labels(self, X):
+        return [self.classes[i] for i in self.predict(X)]
+
+def main(args):
+    parser = OptionParser(usage="%prog [options] DATASET.tab ...")
+    parser.add_option("-o", "--output", default="gaze_model.gzm", help="model file to write")
+    parser.add_option("--l2", type="float", default=1.0, help="L2 penalty")
+    parser.add_option("--min-count", type="int", default=5, help="drop classes with fewer examples")
+    parser.add_option("--unbalanced", action="store_true", default=False, help="don't weigh the classes equally")
+    parser.add_option("--test", action="append", default=[], help="dataset to report the accuracy on")
+    parser.add_option("-c", "--codebook", default=None, help="train on the codes of this codebook")
+    options, args = parser.parse_args(args)
+    if not args:
+        parser.error("no datasets given")
+
+    load = loadTab
+    if options.codebook:
+        from codebook import Codebook
+        codebook = Codebook(options.codebook)
+        def load(path):
+            X, labels = loadTab(path)
+            return codebook.project(X), labels
+
+    data = [load(path) for path in args]
+    X = np.vstack([x for x, l in data])
+    labels = np.array([l for x, ls in data for l in ls])
+
+    names, counts = np.unique(labels, return_counts=True)
+    classes = [str(c) for c, n in zip(names, counts) if n >= options.min_count]
+    keep = np.in1d(labels, classes)
+    y = np.searchsorted(classes, labels[keep])
+    print 'training on %d examples of %s' % (keep.sum(), ', '.join(classes))
+
+    W, b = train(X[keep], y, len(classes), options.l2, not options.unbalanced)
+    saveModel(options.output, W, b, classes)
+
+    model = GazeClassifier(options.output)
+    print 'training accuracy %.4f' % np.mean(model.predict(X[keep]) == y)
+    for path in options.test:
+        Xt, lt = load(path)
+        print '%s accuracy %.4f' % (path, np.mean(np.array(model.labels(Xt)) == np.array(lt)))
+    print 'wrote', options.output
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+''' PCA/whitening codebook for the 400-D face depth descriptors.
+
+    Fit on the Orange datasets, a codebook turns a (faces, 400) descriptor
+    block into (faces, k) float32 codes with one matrix multiply. Codes are
+    stored as float16 in a code store (featurestore.py), 56 bytes a face for
+    k = 20 against 816 for the raw descriptors.
+
+        python codebook.py -k 20 -o codebook.gzp dataset_batches_all.tab
+        python codebook.py -c codebook.gzp --encode batch9_features.gzf batch9_codes.gzc
+
+    A codebook file is a 16 byte header followed by float32 offset (k) and
+    projection (400, k) arrays, memory mapped on load. The offset is the mean
+    descriptor projected, so codes are np.dot(X, projection) - offset.
+'''
+import sys
+import struct
+from optparse import OptionParser
+
+import numpy as np
+
+from classifier import loadTab
+from featurestore import readStore, FeatureWriter, CODE_MAGIC
+
+MAGIC = 'GZPC'
+VERSION = 1
+_HEADER = struct.Struct('<4sHHHH4x') # magic, version, number of features, k, whitened
+HEADER_SIZE = _HEADER.size
+
+CHUNK = 4096 # records encoded at a time
+
+def fitCodebook(X, k=20, whiten=True, eps=1e-3):
+    ''' Mean, (features, k) projection onto the k leading principal
+        components of X and the fraction of the variance they explain. With
+        whiten every component is scaled to unit variance (eps, relative to
+        the largest variance, keeps near-empty components from blowing up). '''
+    X = np.asarray(X, dtype=np.float64)
+    mean = X.mean(axis=0)
+    cov = np.cov(X - mean, rowvar=False)
+    variances, vectors = np.linalg.eigh(cov)
+    order = np.argsort(variances)[::-1][:k]
+    variances, P = variances[order], vectors[:,order]
+
+    """ Fix the signs, so refitting on the same data gives the same codes """
+    P *= np.where(P[np.abs(P).argmax(axis=0), np.arange(P.shape[1])] < 0, -1, 1)
+    if whiten:
+        P = P / np.sqrt(np.maximum(variances, eps * variances[0]))
+    return mean, P, variances.sum() / np.trace(cov)
+
+def saveCodebook(path, mean, P, whiten=True):
+    d, k = P.shape
+    f = open(path, 'wb')
+    f.write(_HEADER.pack(MAGIC, VERSION, d, k, int(whiten)))
+    f.write(np.dot(mean, P).astype('<f4').tostring())
+    f.write(np.asarray(P, dtype='<f4').tostring())
+    f.close()
+
+class Codebook:
+    def __init__(self, path):
+        f = open(path, 'rb')
+        try:
+            magic, version, d, k, whiten = _HEADER.unpack(f.read(HEADER_SIZE))
+        finally:
+            f.close()
+        if magic != MAGIC or version != VERSION:
+            raise IOError('%s is not a version %d codebook' % (path, VERSION))
+        self.nFeatures, self.k, self.whiten = d, k, bool(whiten)
+        self.offset = np.memmap(path, dtype='<f4', mode='r', offset=HEADER_SIZE, shape=(k,))
+        self.projection = np.memmap(path, dtype='<f4', mode='r', offset=HEADER_SIZE + 4*k, shape=(d, k))
+
+    def project(self, X, out=None):
+        ''' (faces, k) float32 codes of a (faces, features) descriptor
+            block, written into out if given. '''
+        out = np.dot(np.asarray(X, dtype=np.float32), self.projection, out=out)
+        out -= self.offset
+        return out
+
+def encodeStore(storePath, codePath, codebook):
+    ''' Write the records of a feature store to a code store, a chunk at a
+        time. Returns the number of records. '''
+    rows = readStore(storePath)
+    writer = FeatureWriter(codePath, 0, codebook.k, '<f2')
+    for start in range(0, len(rows), CHUNK):
+        chunk = rows[start:start+CHUNK]
+        codes = np.zeros(len(chunk), dtype=writer.dtype)
+        for name in ('batch', 'face', 'frame', 'stamp'):
+            codes[name] = chunk[name]
+        codes['features'] = codebook.project(chunk['features'])
+        writer.writeRows(codes)
+    writer.close()
+    return len(rows)
+
+def readCodes(path):
+    ''' Memory map a code store; the codes are in its 'features' field. '''
+    f = open(path, 'rb')
+    try:
+        if f.read(4) != CODE_MAGIC:
+            raise IOError('%s is not a code store' % path)
+    finally:
+        f.close()
+    return readStore(path)
+
+def main(args):
+    parser = OptionParser(usage="%prog [options] DATASET.tab ...\n       %prog -c CODEBOOK --encode STORE CODES")
+    parser.add_option("-k", type="int", default=20, help="number of components")
+    parser.add_option("-o", "--output", default="codebook.gzp", help="codebook file to write")
+    parser.add_option("--no-whiten", action="store_true", default=False, help="keep the components' variances")
+    parser.add_option("-c", "--codebook", default=None, help="codebook to encode with")
+    parser.add_option("--encode", action="store_true", default=False, help="encode feature store STORE into CODES")
+    options, args = parser.parse_args(args)
+
+    if options.encode:
+        if not options.codebook or len(args) != 2:
+            parser.error("--encode needs -c CODEBOOK STORE CODES")
+        n = encodeStore(args[0], args[1], Codebook(options.codebook))
+        print 'encoded %d records into %s' % (n, args[1])
+        return
+
+    if not args:
+        parser.error("no datasets given")
+    X = np.vstack([loadTab(path)[0] for path in args])
+    mean, P, explained = fitCodebook(X, options.k, not options.no_whiten)
+    saveCodebook(options.output, mean, P, not options.no_whiten)
+    print '%d components explain %.1f%% of the variance of %d descriptors' % (options.k, 100*explained, len(X))
+    print 'wrote', options.output
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
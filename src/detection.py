@@ -0,0 +1,53 @@
+''' Helpers for combining face detections from several Haar cascades, and
+    for predicting face sizes from depth. '''
+import numpy as np
+
+from projection import FX
+
+def overlap(a, b):
+    ''' Area of the intersection of boxes a and b, (x1, y1, x2, y2), over the
+        area of the smaller one. A frontal and a profile box around the same
+        face rarely have the same size, so this is used instead of the
+        intersection over union. '''
+    w = min(a[2], b[2]) - max(a[0], b[0])
+    h = min(a[3], b[3]) - max(a[1], b[1])
+    if w <= 0 or h <= 0:
+        return 0.0
+    smaller = min((a[2] - a[0]) * (a[3] - a[1]), (b[2] - b[0]) * (b[3] - b[1]))
+    return w * h / float(max(smaller, 1))
+
+def suppressOverlaps(detections, threshold=0.5):
+    ''' Greedy non-maximum suppression over [(box, neighbors)] from any number
+        of cascades: boxes are taken in order of decreasing neighbor count (a
+        cascade's confidence), and a box is dropped when it overlaps one
+        already kept by more than threshold. Returns the kept boxes. '''
+    kept = []
+    for box, n in sorted(detections, key=lambda d: -d[1]):
+        if all(overlap(box, k) <= threshold for k in kept):
+            kept.append(box)
+    return kept
+
+FOCAL = FX # Kinect depth focal length in pixels
+
+def medianDepth(depth, box):
+    ''' Median of the valid (non zero) depth inside box, 0 if there is none. '''
+    x1, y1, x2, y2 = [int(round(c)) for c in box]
+    d = depth[max(y1, 0):max(y2, 0), max(x1, 0):max(x2, 0)]
+    d = d[d > 0]
+    if len(d) == 0:
+        return 0
+    return np.median(d)
+
+def expectedFaceSize(depth, faceWidth=0.2, focal=FOCAL):
+    ''' Width in pixels of a face faceWidth metres wide at depth millimetres. '''
+    return focal * faceWidth / (0.001 * depth)
+
+def sizeBand(depth, box, band=1.3, faceWidth=0.2, focal=FOCAL):
+    ''' (smallest, largest) face width in pixels worth looking for in box, a
+        factor band either side of the size expected from its median depth,
+        or None without valid depth. '''
+    z = medianDepth(depth, box)
+    if z <= 0:
+        return None
+    size = expectedFaceSize(z, faceWidth, focal)
+    return (size / band, size * band)
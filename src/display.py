@@ -0,0 +1,115 @@
+import threading
+import time
+
+import cv
+import numpy as np
+
+from frameslot import LatestSlot
+
+class Display:
+    ''' Draws the most recent processing results on its own thread, at most
+        rate times a second, so the GUI never sits on the processing path.
+        Frames arriving faster than that are simply skipped. With headless
+        set no window is ever created and show() is a no-op.
+
+        The HighGUI windows, mouse callback and key polling all live on the
+        display thread. 't' toggles the FPS text, any other key is passed to
+        on_key as a lower case character. Render times go to profiler as
+        the display stage. '''
+    def __init__(self, window_name, rate=15.0, headless=False, on_mouse=None, on_key=None, profiler=None):
+        self.window_name = window_name
+        self.period = 1.0 / rate if rate > 0 else 0.0
+        self.headless = headless
+        self.on_mouse = on_mouse
+        self.on_key = on_key
+        self.profiler = profiler
+        self.show_text = True
+
+        self.slot = LatestSlot()
+        self.running = False
+        self.thread = None
+        self.canvas = None
+        if not headless:
+            self.running = True
+            self.thread = threading.Thread(target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def show(self, image, faces, fps, detections=()):
+        ''' Hand over a BGR frame (which the caller must not modify any more),
+            its face boxes, the processing rate and the cascade detections to
+            draw. The frame itself is never drawn into, it may wrap a message
+            buffer. '''
+        if not self.headless:
+            self.slot.put((image, faces, fps, detections))
+
+    def run(self):
+        cv.NamedWindow(self.window_name, cv.CV_NORMAL)
+        cv.ResizeWindow(self.window_name, 640, 480)
+        cv.NamedWindow('face box')
+        if self.on_mouse:
+            cv.SetMouseCallback(self.window_name, self.on_mouse, None)
+
+        text_font = cv.InitFont(cv.CV_FONT_VECTOR0, 1, 1, 0, 2, 8)
+
+        while self.running:
+            st = time.time()
+
+            frame = self.slot.get(timeout=self.period or 0.1)
+            if frame is not None:
+                rst = time.time()
+                self.render(frame, text_font)
+                if self.profiler is not None:
+                    self.profiler.add('display', time.time() - rst)
+
+            """ Handle keyboard events """
+            keystroke = cv.WaitKey(2)
+            if 32 <= keystroke and keystroke < 128:
+                cc = chr(keystroke).lower()
+                if cc == 't':
+                    self.show_text = not self.show_text
+                elif self.on_key:
+                    self.on_key(cc)
+
+            """ Cap the refresh rate """
+            remaining = self.period - (time.time() - st)
+            if remaining > 0:
+                time.sleep(remaining)
+
+        cv.DestroyAllWindows()
+
+    def render(self, frame, text_font):
+        image, faces, fps, detections = frame
+        # draw on a copy, reused from frame to frame
+        if self.canvas is None or self.canvas.shape != image.shape:
+            self.canvas = np.empty_like(image)
+        self.canvas[...] = image
+        display_image = cv.fromarray(self.canvas)
+
+        if faces:
+            x1, y1, x2, y2 = faces[-1]
+            cv.ShowImage('face box', display_image[y1:y2,x1:x2])
+
+        for pl, (x,y,x2,y2) in enumerate(faces):
+            cv.Rectangle(display_image, (cv.Round(x), cv.Round(y)),
+                                        (cv.Round(x2), cv.Round(y2)),
+                                        cv.RGB(255, pl*50, 0), 2, 8, 0)
+
+        """ Cascade detections, thin and green, over the depth boxes """
+        for (x,y,x2,y2) in detections:
+            cv.Rectangle(display_image, (cv.Round(x), cv.Round(y)),
+                                        (cv.Round(x2), cv.Round(y2)),
+                                        cv.RGB(0, 255, 0), 1, 8, 0)
+
+        if self.show_text:
+            """ Print cycles per second (CPS) at top of the image """
+            cv.PutText(display_image, "FPS: " + str(fps), (10, int(image.shape[0] * 0.1)), text_font, cv.RGB(255, 255, 0))
+
+        cv.ShowImage(self.window_name, display_image)
+
+    def stop(self):
+        self.running = False
+        # a shutdown started by a key press runs on the display thread itself,
+        # which then just leaves its loop
+        if self.thread is not None and threading.current_thread() is not self.thread:
+            self.thread.join(1.0)
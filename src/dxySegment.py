@@ -1,11 +1,11 @@
 import numpy as np
 import pickle
-import cv
 from scipy.cluster.vq import vq, kmeans2, whiten, kmeans
 
+from profiler import laps
+
 import random
 
-from pylab import plot, show, scatter
 
 import time
 
@@ -78,6 +78,7 @@ def dxySegment(d_full, nClusters=5, graphics=False, seeds=None, skip=4, verbose=
     if verbose: print 'projected back to image', time.time() - st; st = time.time()
     
     if graphics:
+        import cv # only the debug views need OpenCV
         colors = [[random.randint(0,255)/255.0,random.randint(0,255)/255.0,random.randint(0,255)/255.0] for i in range(nClusters)]
         
         im = np.zeros((width*height,3))
@@ -126,7 +127,204 @@ def dxySegment(d_full, nClusters=5, graphics=False, seeds=None, skip=4, verbose=
     return rects, centroids * [maxD/0.5, height/1.5]
         
     
+# rows of the depth frame that are never searched for heads
+TOP_ROWS = 70
+BOTTOM_ROWS = 200
+
+# flat coordinate grids, keyed by cropped frame shape
+_gridCache = {}
+
+def _grids(shape):
+    if shape not in _gridCache:
+        rows, cols = shape
+        flat = np.arange(rows*cols)
+        col = flat % cols
+        _gridCache[shape] = (flat // cols, col, 1.5*col/cols)
+    return _gridCache[shape]
+
+def weightedKmeans(data, weights, seeds, maxIter=50, tol=1e-6):
+    ''' Lloyd's k-means over weighted points, warm started from seeds and
+        stopped once no centroid moves more than tol. A cluster that loses
+        all its points keeps its previous centroid, as kmeans2 does. '''
+    centroids = np.array(seeds, dtype=np.float64)
+    weights = np.asarray(weights, dtype=np.float64)
+    k = centroids.shape[0]
+    for it in range(maxIter):
+        codes, dist = vq(data, centroids)
+        mass = np.bincount(codes, weights=weights, minlength=k)
+        new = centroids.copy()
+        occupied = mass > 0
+        for j in range(data.shape[1]):
+            new[occupied,j] = np.bincount(codes, weights=weights*data[:,j], minlength=k)[occupied] / mass[occupied]
+        shift = np.max(np.abs(new - centroids))
+        centroids = new
+        if shift <= tol:
+            break
+    return centroids, codes
+
+def histogramKmeans(d, col, dScale, colScale, nClusters=5, seeds=None, depthBin=1):
+    ''' k-means over the (scaled depth, scaled column) samples of dxySegment,
+        run on the occupied bins of their 2-D histogram instead of on every
+        sample. d (integer depth) and col are the raw samples, dScale and
+        colScale the factors dxySegment applies to them. Depth is binned to
+        depthBin units, columns are already integral, so with depthBin=1 this
+        gives the same fit as clustering every sample. '''
+    d = np.asarray(d, dtype=np.int64) // depthBin
+    col = np.asarray(col, dtype=np.int64)
+    dmin = d.min()
+    ncols = col.max() + 1
+    bins, weights = np.unique((d - dmin)*ncols + col, return_counts=True)
+
+    data = np.empty((len(bins), 2))
+    data[:,0] = ((bins // ncols + dmin)*depthBin + 0.5*(depthBin-1)) * dScale
+    data[:,1] = (bins % ncols) * colScale
+
+    if seeds is None:
+        # kmeans2 would seed from random samples, so pick bins by their mass
+        pick = np.random.choice(len(bins), size=min(nClusters, len(bins)), replace=False, p=weights/float(weights.sum()))
+        seeds = data[pick]
+        if len(pick) < nClusters:
+            seeds = np.vstack((seeds, seeds[np.random.randint(len(pick), size=nClusters-len(pick))]))
+    return weightedKmeans(data, weights, seeds)
+
+def _boxes(rows, cols, codes, nClusters, face_height=50, minPixels=0):
+    # rows must be non-decreasing (row-major pixel order). The pixels are
+    # first collapsed into runs of one cluster on one row, whose first and
+    # last columns are the run's extent; per-cluster occupancy tables are
+    # then built over the runs with bincount: the rows each cluster occupies
+    # (its top row is the first one), and the first/last columns of its
+    # runs within face_height rows of that top row
+    if len(codes) == 0:
+        return [], np.zeros(nClusters, dtype=np.intp)
+    nRows, nCols = int(rows[-1]) + 1, int(cols.max()) + 1
+    change = codes[1:] != codes[:-1]
+    change |= rows[1:] != rows[:-1]
+    starts = np.flatnonzero(change) + 1
+    ends = np.append(starts, len(codes)) - 1
+    starts = np.insert(starts, 0, 0)
+    runCodes = codes[starts].astype(np.intp)
+    runRows = rows[starts]
+
+    counts = np.bincount(runCodes, weights=ends - starts + 1, minlength=nClusters)[:nClusters].astype(np.intp)
+    present = np.flatnonzero(counts >= max(minPixels, 1))
+    if len(present) == 0:
+        return [], counts
+
+    rowOcc = np.bincount(runCodes*nRows + runRows, minlength=nClusters*nRows).reshape(nClusters, nRows) > 0
+    top = rowOcc.argmax(axis=1)
+
+    band = runRows < (top + face_height)[runCodes]
+    firstOcc = np.bincount(runCodes[band]*nCols + cols[starts[band]], minlength=nClusters*nCols).reshape(nClusters, nCols) > 0
+    lastOcc = np.bincount(runCodes[band]*nCols + cols[ends[band]], minlength=nClusters*nCols).reshape(nClusters, nCols) > 0
+    ymin = firstOcc.argmax(axis=1)
+    ymax = nCols - 1 - lastOcc[:,::-1].argmax(axis=1)
+
+    rects = [[int(ymin[k])-1, int(top[k]), int(ymax[k])+1, int(top[k])+face_height] for k in present]
+    return rects, counts
+
+def clusterBoxes(labels, nClusters, face_height=50, minPixels=0):
+    ''' Face boxes of every cluster of a label image in a single pass: the
+        top-most row of the cluster, and the column extent of its pixels in
+        the face_height rows below it. Clusters with fewer than minPixels
+        pixels are dropped. Returns the rects, in cluster order, and the
+        pixel count of every cluster. '''
+    rows, cols = np.nonzero(labels >= 0)
+    return _boxes(rows, cols, labels[rows, cols], nClusters, face_height, minPixels)
+
+def dxySegmentSparse(d_full, nClusters=5, graphics=False, seeds=None, skip=4, verbose=False, engine='kmeans2', minPixels=0, profiler=None):
+    ''' Same segmentation as dxySegment, but the coordinate grids are cached
+        per frame shape and clusters are only assigned to pixels with valid
+        depth inside the searched band, instead of to every pixel of the frame.
+
+        engine selects the clustering: 'kmeans2' as in dxySegment, or
+        'histogram' for weighted k-means over the occupied (depth, column)
+        bins, which runs until convergence and makes subsampling (skip)
+        unnecessary. Clusters with fewer than minPixels pixels get no rect.
+        The prepare/cluster/project/boxes stage times are recorded in
+        profiler, if given, as segment.<stage>.
+
+        Returns rects, centroids and a compact label image of the cropped
+        frame (-1 where depth is invalid or outside the band). A frame with
+        no valid depth in the near band has no rects, and the seeds are
+        returned unchanged as its centroids. '''
+    if seeds is not None:
+        nClusters = seeds.shape[0]
+
+    stst = time.time()
+    timer = laps(profiler, 'segment.', verbose)
+
+    d = d_full[:-BOTTOM_ROWS,:] # a view, d_full is never copied
+    rows, cols = d.shape
+    d = d.reshape(-1)
+    rowIdx, colIdx, colScaled = _grids((rows, cols))
+
+    valid = np.flatnonzero(d)
+    valid = valid[valid >= TOP_ROWS*cols]
+    if len(valid) == 0:
+        return [], seeds, -np.ones((rows, cols), dtype=np.int8)
+
+    d_valid = d[valid]
+    maxD = float(np.max(d_valid))
+    d_scaled = (0.5/maxD)*d_valid
+    Y_scaled = colScaled[valid]
+    prevSeeds = seeds
+    if seeds is not None:
+        seeds = seeds * [0.5/maxD, 1.5/cols]
+
+    # same subsampling as dxySegment: every skip-th pixel of the cropped frame
+    sample = valid % skip == 0 if skip > 1 else slice(None)
+    d_filtered = d_scaled[sample]
+    Y_filtered = Y_scaled[sample]
+
+    # should use a proper distance threshold here
+    near = d_filtered < 0.18
+    if not near.any():
+        # nobody in the near band: nothing to cluster, keep the caller's seeds
+        return [], prevSeeds, -np.ones((rows, cols), dtype=np.int8)
+
+    timer.lap('prepare')
+
+    if engine == 'histogram':
+        centroids, idx = histogramKmeans(d_valid[sample][near], colIdx[valid][sample][near],
+                                         0.5/maxD, 1.5/cols, nClusters=nClusters, seeds=seeds)
+    else:
+        dataset = np.vstack((d_filtered[near],Y_filtered[near]))
+        if seeds is not None:
+            centroids, idx = kmeans2(dataset.T,seeds)
+        else:
+            centroids, idx = kmeans2(dataset.T,nClusters)
+
+    timer.lap('cluster')
+
+    codes, dist = vq(np.vstack((d_scaled,Y_scaled)).T,centroids)
+
+    labels = np.empty(rows*cols, dtype=np.int8 if nClusters < 128 else np.int32)
+    labels.fill(-1)
+    labels[valid] = codes
+    labels.shape = (rows, cols)
+
+    timer.lap('project')
+
+    rects, counts = _boxes(rowIdx[valid], colIdx[valid], codes, len(centroids), minPixels=minPixels)
+
+    timer.lap('boxes')
+    if verbose: print rects
+    if verbose: print 'total time', time.time() - stst
+
+    if graphics:
+        import cv
+        colors = np.array([[random.randint(0,255)/255.0,random.randint(0,255)/255.0,random.randint(0,255)/255.0] for i in range(nClusters)])
+        im = np.zeros((rows,cols,3))
+        im[labels >= 0] = colors[labels[labels >= 0]]
+        cv_im = cv.fromarray(im)
+        for (x1, y1, x2, y2) in rects:
+            cv.Rectangle(cv_im, (x1, y1), (x2, y1+60), (0, 255, 255), 2)
+        cv.ShowImage("blah",cv_im)
+
+    return rects, centroids * [maxD/0.5, cols/1.5], labels
+
 if __name__ == '__main__':
+    import cv
     f = open('/home/ben/Desktop/ros/gaze-tracking-cmu/src/It2_depth.dat','r')
     im1 = pickle.load(f)
     
@@ -0,0 +1,66 @@
+import numpy as np
+
+# number of people in each recorded batch, which is also the number of
+# depth clusters dxySegment looks for
+PEOPLE_PER_BATCH = [5,4,4,3,3,5,4,3,3]
+
+def _cellEdges(lo, hi, size):
+    ''' Start and end (exclusive) of size equal cells over [lo, hi), for
+        every box at once. Each cell is at least one pixel wide, so boxes
+        smaller than size repeat pixels instead of leaving empty cells. '''
+    k = np.arange(size + 1)
+    edges = lo[:,np.newaxis] + (k * (hi - lo)[:,np.newaxis]) // size
+    start = edges[:,:-1]
+    end = np.maximum(edges[:,1:], start + 1)
+    return start, end
+
+def faceDescriptors(np_depth, faces, size=20, out=None):
+    ''' Descriptors of every face box of a frame at once, as rows of a
+        (len(faces), size*size) uint16 array, written into out if given.
+
+        Each cell is the area average of the valid (non zero) depth it
+        covers, so shadows and holes don't drag it towards zero. Cells
+        without any valid depth are 0. All cells of all faces are read off
+        one summed area table over the faces' bounding box. '''
+    n = len(faces)
+    if out is None:
+        out = np.empty((n, size*size), dtype=np.uint16)
+    if n == 0:
+        return out
+
+    rows, cols = np_depth.shape
+    boxes = np.array(faces, dtype=np.int64).reshape(n, 4)
+    x1 = np.clip(boxes[:,0], 0, cols)
+    y1 = np.clip(boxes[:,1], 0, rows)
+    x2 = np.clip(boxes[:,2], x1, cols)
+    y2 = np.clip(boxes[:,3], y1, rows)
+
+    """ Summed area tables of depth and of valid pixels, with a zero first row
+        and column, over the bounding box of all faces """
+    bx1, by1, bx2, by2 = x1.min(), y1.min(), x2.max(), y2.max()
+    d = np_depth[by1:by2,bx1:bx2]
+    sums = np.zeros((by2-by1+1, bx2-bx1+1), dtype=np.int64)
+    counts = np.zeros((by2-by1+1, bx2-bx1+1), dtype=np.int32)
+    np.cumsum(np.cumsum(d, axis=0, dtype=np.int64), axis=1, out=sums[1:,1:])
+    np.cumsum(np.cumsum(d != 0, axis=0, dtype=np.int32), axis=1, out=counts[1:,1:])
+
+    """ Cell edges relative to the tables, boxes outside the frame get
+        empty cells and so read as invalid """
+    r0, r1 = _cellEdges(y1 - by1, np.maximum(y2 - by1, y1 - by1 + 1), size)
+    c0, c1 = _cellEdges(x1 - bx1, np.maximum(x2 - bx1, x1 - bx1 + 1), size)
+    r0, r1 = np.minimum(r0, by2 - by1)[:,:,np.newaxis], np.minimum(r1, by2 - by1)[:,:,np.newaxis]
+    c0, c1 = np.minimum(c0, bx2 - bx1)[:,np.newaxis,:], np.minimum(c1, bx2 - bx1)[:,np.newaxis,:]
+
+    def area(table):
+        return table[r1,c1] - table[r0,c1] - table[r1,c0] + table[r0,c0]
+    total = area(sums)
+    valid = area(counts)
+
+    average = (total + valid // 2) // np.maximum(valid, 1)
+    out[:] = average.reshape(n, size*size)
+    return out
+
+def featureRow(faceNum, descriptor):
+    ''' One line of a batchN_features.dat file: the 1-based face number
+        followed by the flattened descriptor, tab separated. '''
+    return str(faceNum) + '\t' + '\t'.join([str(x) for x in np.asarray(descriptor).flatten()]) + '\n'
@@ -0,0 +1,189 @@
+''' Append-only binary store for face depth descriptors.
+
+    A store is a 16 byte header followed by fixed-width little-endian records
+    (see storeDtype), so it can be appended to while recording and read back
+    with a memory map. It replaces the tab separated batchN_features.dat text
+    files; datToStore/storeToDat and tabToStore/storeToTab convert between the
+    formats.
+
+    A code store has the same layout with float16 PCA codes (see codebook.py)
+    in place of the uint16 descriptors, and its own magic.
+'''
+import os
+import struct
+import threading
+import Queue
+
+import numpy as np
+
+MAGIC = 'GZFS'
+CODE_MAGIC = 'GZCS'
+VERSION = 1
+_HEADER = struct.Struct('<4sHH8x') # magic, version, number of features
+HEADER_SIZE = _HEADER.size
+_FEATURE_TYPES = {MAGIC: '<u2', CODE_MAGIC: '<f2'}
+_MAGICS = dict((t, m) for m, t in _FEATURE_TYPES.items())
+
+def storeDtype(nFeatures=400, featureType='<u2'):
+    return np.dtype([('batch', '<u2'),
+                     ('face', '<u2'),
+                     ('frame', '<u4'),
+                     ('stamp', '<f8'),
+                     ('features', featureType, (nFeatures,))])
+
+def _readHeader(f):
+    ''' (number of features, feature type) of a store '''
+    magic, version, nFeatures = _HEADER.unpack(f.read(HEADER_SIZE))
+    if magic not in _FEATURE_TYPES or version != VERSION:
+        raise IOError('%s is not a version %d feature store' % (f.name, VERSION))
+    return nFeatures, _FEATURE_TYPES[magic]
+
+def readStore(path):
+    ''' Memory map a store as a read-only structured array of records. '''
+    f = open(path, 'rb')
+    try:
+        nFeatures, featureType = _readHeader(f)
+    finally:
+        f.close()
+    dtype = storeDtype(nFeatures, featureType)
+    n = (os.path.getsize(path) - HEADER_SIZE) // dtype.itemsize
+    if n == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r', offset=HEADER_SIZE, shape=(n,))
+
+class FeatureWriter:
+    ''' Appends records to a store from a background thread. write() only
+        queues the row; the thread writes everything queued so far in one go,
+        so the caller never waits on the disk. '''
+    def __init__(self, path, batch=0, nFeatures=400, featureType='<u2'):
+        self.batch = batch
+        self.dtype = storeDtype(nFeatures, featureType)
+
+        self.file = open(path, 'ab')
+        if self.file.tell() == 0:
+            self.file.write(_HEADER.pack(_MAGICS[featureType], VERSION, nFeatures))
+        else:
+            f = open(path, 'rb')
+            try:
+                if _readHeader(f) != (nFeatures, featureType):
+                    raise IOError('%s holds descriptors of a different length or type' % path)
+            finally:
+                f.close()
+            # drop a partial record left by an interrupted writer
+            end = HEADER_SIZE + (self.file.tell() - HEADER_SIZE) // self.dtype.itemsize * self.dtype.itemsize
+            self.file.truncate(end)
+            self.file.seek(end)
+
+        self.queue = Queue.Queue()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write(self, face, features, stamp=0.0, frame=0):
+        row = np.zeros(1, dtype=self.dtype)
+        row['batch'] = self.batch
+        row['face'] = face
+        row['frame'] = frame
+        row['stamp'] = stamp
+        row['features'] = np.asarray(features).reshape(-1)
+        self.queue.put(row)
+
+    def writeFaces(self, features, stamp=0.0, frame=0):
+        ''' Queue the (faces, nFeatures) descriptors of one frame, numbering
+            the faces from 1. features is copied, so it may be reused. '''
+        rows = np.zeros(len(features), dtype=self.dtype)
+        rows['batch'] = self.batch
+        rows['face'] = np.arange(1, len(features) + 1)
+        rows['frame'] = frame
+        rows['stamp'] = stamp
+        rows['features'] = features
+        self.queue.put(rows)
+
+    def writeRows(self, rows):
+        ''' Queue a structured array of records at once. '''
+        self.queue.put(np.asarray(rows, dtype=self.dtype))
+
+    def _run(self):
+        done = False
+        while not done:
+            rows = [self.queue.get()]
+            while True:
+                try:
+                    rows.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+            if rows[-1] is None:
+                rows.pop()
+                done = True
+            if rows:
+                self.file.write(np.concatenate(rows).tostring())
+                self.file.flush()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.file.close()
+
+def datToStore(datPath, storePath, batch=0):
+    ''' Convert a batchN_features.dat text file. Rows of one frame are
+        numbered 1..n, so a new frame starts wherever the face number
+        doesn't increase. Returns the number of records written. '''
+    data = np.fromstring(open(datPath).read(), dtype=np.int64, sep=' ')
+    if len(data) == 0:
+        return 0
+    data.shape = (-1, len(open(datPath).readline().split()))
+
+    face = data[:,0]
+    frame = np.concatenate(([0], np.cumsum(face[1:] <= face[:-1])))
+
+    rows = np.zeros(len(data), dtype=storeDtype(data.shape[1]-1))
+    rows['batch'] = batch
+    rows['face'] = face
+    rows['frame'] = frame
+    rows['features'] = data[:,1:]
+
+    writer = FeatureWriter(storePath, batch, data.shape[1]-1)
+    writer.writeRows(rows)
+    writer.close()
+    return len(rows)
+
+def storeToDat(storePath, datPath):
+    rows = readStore(storePath)
+    np.savetxt(datPath, np.column_stack((rows['face'], rows['features'])), fmt='%d', delimiter='\t')
+
+def tabToStore(tabPath, storePath, batch=0):
+    ''' Convert the descriptors of an Orange .tab dataset (three header
+        lines, then descriptor columns and a class column). The store has no
+        class column, so the labels are returned. '''
+    f = open(tabPath)
+    nFeatures = len(f.readline().rstrip('\n').split('\t')) - 1
+    f.readline(); f.readline()
+    features, labels = [], []
+    for line in f:
+        tokens = line.rstrip('\n').split('\t')
+        features.append(tokens[:nFeatures])
+        labels.append(tokens[nFeatures])
+    f.close()
+
+    rows = np.zeros(len(features), dtype=storeDtype(nFeatures))
+    rows['batch'] = batch
+    rows['frame'] = np.arange(len(rows))
+    if len(rows):
+        rows['features'] = np.array(features, dtype=np.float64)
+
+    writer = FeatureWriter(storePath, batch, nFeatures)
+    writer.writeRows(rows)
+    writer.close()
+    return labels
+
+def storeToTab(storePath, tabPath, labels, className='class_view'):
+    ''' Write a store as an Orange .tab dataset, one label per record. '''
+    rows = readStore(storePath)
+    nFeatures = rows.dtype['features'].shape[0]
+    fw = open(tabPath, 'w')
+    fw.write('\t'.join([str(i) for i in range(nFeatures)]) + '\t' + className + '\n')
+    fw.write('c\t'*nFeatures + 'd\n')
+    fw.write('\t'*nFeatures + 'class\n')
+    for features, lbl in zip(rows['features'], labels):
+        fw.write('\t'.join([str(x) for x in features]) + '\t' + lbl + '\n')
+    fw.close()
@@ -0,0 +1,74 @@
+import threading
+
+import numpy as np
+
+class LatestSlot:
+    ''' A bounded hand-off between a producer (a ROS callback) and a worker
+        thread that holds only the newest item. put() never blocks: an item
+        the worker hasn't picked up yet is replaced and counted as dropped, so
+        the worker always sees data at most one processing period old. '''
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.item = None
+        self.full = False
+        self.put_count = 0
+        self.dropped = 0
+
+    def put(self, item):
+        self.cond.acquire()
+        try:
+            if self.full:
+                self.dropped += 1
+            self.item = item
+            self.full = True
+            self.put_count += 1
+            self.cond.notify()
+        finally:
+            self.cond.release()
+
+    def get(self, timeout=None):
+        ''' The newest item, or None if nothing arrived within timeout. '''
+        self.cond.acquire()
+        try:
+            if not self.full:
+                self.cond.wait(timeout)
+            if not self.full:
+                return None
+            item, self.item, self.full = self.item, None, False
+            return item
+        finally:
+            self.cond.release()
+
+class BufferPool:
+    ''' A fixed set of preallocated arrays with explicit ownership: a buffer
+        belongs to whoever acquire()d it until it is release()d, and is only
+        ever written by its owner, so nobody reads a half overwritten frame.
+        With two buffers one frame can be filled while the previous one is
+        still in use. '''
+    def __init__(self, shape, dtype=np.uint16, count=2):
+        self.shape, self.dtype = tuple(shape), np.dtype(dtype)
+        self.cond = threading.Condition()
+        self.free = [np.empty(self.shape, dtype=self.dtype) for i in range(count)]
+        self.waits = 0
+
+    def acquire(self, timeout=None):
+        ''' A free buffer, waiting for one to be released if there is none,
+            or None if none was within timeout. '''
+        self.cond.acquire()
+        try:
+            if not self.free:
+                self.waits += 1
+                self.cond.wait(timeout)
+            if not self.free:
+                return None
+            return self.free.pop()
+        finally:
+            self.cond.release()
+
+    def release(self, buf):
+        self.cond.acquire()
+        try:
+            self.free.append(buf)
+            self.cond.notify()
+        finally:
+            self.cond.release()
@@ -1,18 +1,241 @@
 #!/usr/bin/env python
 import roslib; roslib.load_manifest('gaze-tracking-cmu')
 import rospy
-from sensor_msgs.msg import PointCloud2, PointField, Image, RegionOfInterest
+from sensor_msgs.msg import PointCloud2, PointField, Image, RegionOfInterest, CameraInfo
 from visualization_msgs.msg import MarkerArray, Marker
 from geometry_msgs.msg import Point
+from diagnostic_msgs.msg import DiagnosticArray, DiagnosticStatus, KeyValue
+from std_msgs.msg import String
 import numpy as np
-from point_cloud import read_points, create_cloud, create_cloud_xyz32
-from scipy.linalg import eig, norm
+from point_cloud import read_points, create_cloud, create_cloud_xyz32, create_cloud_xyz32_array
+from scipy.linalg import norm
 import cv
 from cv_bridge import CvBridge, CvBridgeError
 import time
 import sys
+import traceback
+import threading
+import Queue
+from multiprocessing.pool import ThreadPool
+from collections import deque
 from lk import lk
-from dxySegment import dxySegment
+from dxySegment import dxySegment, dxySegmentSparse
+from normals import estimateNormals
+from features import PEOPLE_PER_BATCH, faceDescriptors, featureRow
+from frameslot import LatestSlot, BufferPool
+from featurestore import FeatureWriter
+from display import Display
+from profiler import Profiler, laps
+from detection import suppressOverlaps, sizeBand
+from projection import rayTable, rayTableFromCameraInfo, OrganizedCloud
+from classifier import GazeClassifier
+from codebook import Codebook
+from markers import MarkerCache, arrowMarker
+
+DEPTH_MM_ENCODINGS = ('16UC1', 'mono16') # depth in millimetres, used in place
+
+class GazeStream:
+    """ Everything that belongs to one camera: its topics, the pairing of
+        its RGB and depth frames, segmentation seeds, feature file and
+        buffers. A stream is only ever processed by one worker at a time, so
+        none of this needs locking. Parameters are read from ~namespace/name
+        first, then from ~name. """
+    def __init__(self, gaze, namespace=""):
+        self.gaze = gaze
+        self.namespace = namespace
+        self.name = namespace or gaze.node_name
+        prefix = namespace + "/" if namespace else ""
+        self.input_rgb_image = prefix + "input_rgb_image"
+        self.input_depth_image = prefix + "input_depth_image"
+        
+        """ RGB and depth frames are paired on header stamps, whichever arrives last """
+        self.depth_queue = deque(maxlen=self.param("depth_queue_size", 5))
+        self.rgb_queue = deque(maxlen=self.param("rgb_queue_size", 5)) # RGB frames waiting for their depth
+        self.pair_lock = threading.Lock()
+        self.last_depth_key = None
+        self.frame_slot = LatestSlot()
+        self.scheduled = False
+        
+        """ Depth that can't be used in place is copied once into one of
+            depth_buffers pooled buffers """
+        self.depth_buffers = self.param("depth_buffers", 2)
+        self.depth_pool = None
+        self.depth_buffer = None
+        
+        """ With publish_normals every frame's face cloud goes out on gaze_cloud
+            and a normal per face on gaze_normals """
+        self.publish_normals = self.param("publish_normals", False)
+        self.pubFaceCloud = rospy.Publisher(prefix + 'gaze_cloud', PointCloud2)
+        
+        """ Face normal arrows go out as one MarkerArray per frame holding only the
+            arrows that moved more than marker_tolerance metres, appeared or went away """
+        self.pubFaceNormals = rospy.Publisher(prefix + 'gaze_normals', MarkerArray)
+        self.normalMarkers = MarkerCache(self.pubFaceNormals, tolerance=self.param("marker_tolerance", 0.01),
+                                         refresh=self.param("marker_refresh", 30))
+        self.prefix = prefix
+        self.pubGazeTargets = {} # person number: publisher, created as people appear
+        
+        self.image = None
+        self.image_size = None
+        self.depth_image = None
+        self.grey = None
+        self.small_image = None
+        self.scaled_image = None
+        self.storages = [cv.CreateMemStorage(0) for cascade in gaze.cascades]
+        
+        """ Depth is projected to XYZ through a ray table, for the Kinect's
+            intrinsics or, with use_camera_info, those of the camera info topic """
+        self.rays = rayTable()
+        self.cloud = None
+        if self.param("use_camera_info", False):
+            self.camera_info_sub = rospy.Subscriber(prefix + "input_camera_info", CameraInfo, self.camera_info_callback)
+        
+        self.detect_count = 0
+        self.prev_detections = []
+        self.tracks_lost = False
+        
+        self.seeds = None
+        
+        self.batch = self.param("batch", 9)
+        """ Features go to a binary feature store, or to the old tab separated text with feature_format: text,
+            or as PCA codes to a code store with feature_format: codes """
+        self.feature_format = self.param("feature_format", "binary")
+        if self.feature_format == "codes" and gaze.codebook is None:
+            message = "%s: feature_format codes needs a codebook, set the ~codebook param" % self.name
+            rospy.logfatal(message)
+            raise ValueError(message)
+        name = namespace + "_batch%d_features" % self.batch if namespace else "batch%d_features" % self.batch
+        if self.feature_format == "text":
+            self.featureFile = open(self.param("feature_file", '/home/ben/Desktop/features/%s.dat' % name),'w')
+        elif self.feature_format == "codes":
+            self.featureFile = FeatureWriter(self.param("feature_file", '/home/ben/Desktop/features/%s.gzc' % name), self.batch,
+                                             gaze.codebook.k, '<f2')
+        else:
+            self.featureFile = FeatureWriter(self.param("feature_file", '/home/ben/Desktop/features/%s.gzf' % name), self.batch)
+        self.frameNum = 0
+        self.clusters = PEOPLE_PER_BATCH[self.batch-1]
+        
+        """ Descriptors of the current frame's faces, one row each, in a
+            buffer reused from frame to frame """
+        self.descriptors = np.empty((self.clusters, 400), dtype=np.uint16)
+        self.faceDescriptors = self.descriptors[:0]
+        if gaze.codebook is not None:
+            self.codes = np.empty((self.clusters, gaze.codebook.k), dtype=np.float32)
+            self.faceCodes = self.codes[:0]
+        
+        """ Completion times of the last frames, for the stream's throughput """
+        self.done_times = deque(maxlen=100)
+        self.cps = 0
+        
+        """ Subscribe to the raw camera image topics """
+        self.image_sub = rospy.Subscriber(self.input_rgb_image, Image, self.image_callback)
+        self.depth_sub = rospy.Subscriber(self.input_depth_image, Image, self.depth_callback)
+    
+    def param(self, name, default):
+        if self.namespace and rospy.has_param("~%s/%s" % (self.namespace, name)):
+            return rospy.get_param("~%s/%s" % (self.namespace, name))
+        return rospy.get_param("~" + name, default)
+            
+    def camera_info_callback(self, info):
+        """ Tables are cached per intrinsics, so this is only expensive once """
+        self.rays = rayTableFromCameraInfo(info)
+        
+    def depth_callback(self, data):
+        """ Just queue the message, it is only decoded once paired with an RGB frame """
+        self.pair_lock.acquire()
+        try:
+            self.depth_queue.append(data)
+            self.pair_frames()
+        finally:
+            self.pair_lock.release()
+        
+    def match_depth(self, stamp):
+        """ The queued depth message closest in time to stamp, or None if none
+            is within sync_slop seconds, and whether that is final: depth
+            arrives in stamp order, so once there is depth at or after stamp
+            no later message can be closer """
+        best, best_dt = None, self.gaze.sync_slop
+        final = False
+        for msg in list(self.depth_queue):
+            dt = (msg.header.stamp - stamp).to_sec()
+            if abs(dt) <= best_dt:
+                best, best_dt = msg, abs(dt)
+            final = final or dt >= 0
+        return best, final
+
+    def image_callback(self, data):
+        """ Queue the RGB frame until its depth frame is known """
+        self.pair_lock.acquire()
+        try:
+            self.rgb_queue.append(data)
+            self.pair_frames()
+        finally:
+            self.pair_lock.release()
+    
+    def pair_frames(self):
+        """ Pair queued RGB frames, oldest first, with their depth frames and hand
+            them to the worker pool; anything slower than that happens in
+            process_frame. An RGB frame waits for depth until depth stamped at
+            or after it has arrived, so the pairing doesn't depend on which
+            topic is delivered first """
+        while self.rgb_queue:
+            data = self.rgb_queue[0]
+            depth_msg, final = self.match_depth(data.header.stamp)
+            if not final:
+                return
+            self.rgb_queue.popleft()
+            if depth_msg is None: 
+                print 'no depth image'
+                continue
+            
+            """ Only process each depth frame once """
+            depth_key = (depth_msg.header.stamp, depth_msg.header.seq)
+            if depth_key == self.last_depth_key:
+                continue
+            self.last_depth_key = depth_key
+            
+            self.frame_slot.put((data, depth_msg))
+            self.gaze.schedule(self)
+    
+    def acquire_depth(self, depth_msg):
+        """ The depth of depth_msg as a native uint16 array of millimetres. Usually
+            this is a view of the message, which is never modified. Byte swapped
+            or 32FC1 depth is decoded into a buffer from depth_pool that stays owned by this
+            stream until its next frame's depth replaces it. """
+        buf = None
+        if self.gaze.depth_in_place(depth_msg):
+            np_depth = self.gaze.convert_depth_array(depth_msg)
+        else:
+            shape = (depth_msg.height, depth_msg.width)
+            if self.depth_pool is None or self.depth_pool.shape != shape:
+                self.depth_pool = BufferPool(shape, np.uint16, max(2, self.depth_buffers))
+            buf = self.gaze.convert_depth_array(depth_msg, self.depth_pool.acquire())
+            np_depth = buf
+        
+        if self.depth_buffer is not None and self.depth_buffer.shape == self.depth_pool.shape:
+            self.depth_pool.release(self.depth_buffer)
+        self.depth_buffer = buf
+        return np_depth
+    
+    def frame_done(self):
+        self.done_times.append(time.time())
+        self.cps = int(round(self.throughput()))
+    
+    def throughput(self):
+        """ Frames per second over the last frames processed """
+        if len(self.done_times) < 2:
+            return 0.0
+        return (len(self.done_times) - 1) / max(self.done_times[-1] - self.done_times[0], 1e-6)
+    
+    def publish_targets(self, labels):
+        """ The gaze target of every person (face number) on its own topic """
+        for person, label in enumerate(labels):
+            if person+1 not in self.pubGazeTargets:
+                self.pubGazeTargets[person+1] = rospy.Publisher(self.prefix + 'person%d/gaze_target' % (person+1), String)
+            self.pubGazeTargets[person+1].publish(String(label))
+    
+    def close(self):
+        self.featureFile.close()
 
 class Gaze:
     def __init__(self, node_name):
@@ -21,42 +244,32 @@ class Gaze:
         rospy.on_shutdown(self.cleanup)
     
         self.node_name = node_name
-        self.input_rgb_image = "input_rgb_image"
-        self.input_depth_image = "input_depth_image"
         
-        self.prevDepth = None
-        
-        self.pubFaceCloud = rospy.Publisher('gaze_cloud', PointCloud2)
+        """ RGB and depth frames are paired on header stamps """
+        self.sync_slop = rospy.get_param("~sync_slop", 0.016) # seconds, under half a 30 Hz frame period
                 
         """ Initialize a number of global variables """
-        self.image = None
-        self.image_size = None
-        self.depth_image = None
-        self.grey = None
-        self.small_image = None
-        self.prev = None
-        self.prev_img = None
-        self.show_text = True
         self.prevFrameNum = 1
-        
-        self.mask = None
 
-        """ Create the display window """
+        """ Per-stage timing, published on /diagnostics and dumped on shutdown """
+        self.profiler = Profiler(window=rospy.get_param("~profile_window", 1000))
+        self.profile_file = rospy.get_param("~profile_file", "gaze_profile.json")
+        self.frame_budget = rospy.get_param("~frame_budget", 1.0/30) # seconds
+        self.pubDiagnostics = rospy.Publisher('/diagnostics', DiagnosticArray)
+        
+        """ Create the display, which owns the windows and the mouse callback.
+            With headless set there are no windows at all. """
         self.cv_window_name = self.node_name
-        cv.NamedWindow(self.cv_window_name, cv.CV_NORMAL)
-        cv.ResizeWindow(self.cv_window_name, 640, 480)
-        
-        cv.NamedWindow('face box')
+        self.display = Display(self.cv_window_name, rate=rospy.get_param("~display_rate", 15.0),
+                               headless=rospy.get_param("~headless", False),
+                               on_mouse=self.on_mouse_click, on_key=self.on_key,
+                               profiler=self.profiler)
         
         """ Create the cv_bridge object """
         self.bridge = CvBridge()   
         
-        """ Set a call back on mouse clicks on the image window """
-        cv.SetMouseCallback (self.node_name, self.on_mouse_click, None)  
-        
-        """ Subscribe to the raw camera image topic and set the image processing callback """
-        self.image_sub = rospy.Subscriber(self.input_rgb_image, Image, self.image_callback)
-        self.depth_sub = rospy.Subscriber(self.input_depth_image, Image, self.depth_callback)
+        """ Default ray table, each stream has its own """
+        self.rays = rayTable()
         
         #rospy.Subscriber("/camera/depth/image", Image, callback, 
         #                 queue_size=1, callback_args=(pubFaceCloud,pubFaceNormals)) 
@@ -86,83 +299,270 @@ class Gaze:
         self.min_neighbors = 1
         self.haar_flags = cv.CV_HAAR_DO_CANNY_PRUNING
         
-        self.seeds = None
-        
-        self.cps = 0 # Cycles per second = number of processing loops per second.
-        self.cps_values = list()
-        self.cps_n_values = 20
-        
-        self.featureFile = open('/home/ben/Desktop/features/batch9_features.dat','w')
-        self.clusters = [5,4,4,3,3,5,4,3,3][9-1]
-        
+        """ The cascades run concurrently (OpenCV releases the GIL while
+            detecting), with a memory storage per stream and cascade. A
+            cascade object can't be used by two threads at once, so streams
+            take turns on each cascade. Boxes of the same face from different
+            cascades are merged when they overlap by more than
+            overlap_threshold. """
+        self.cascades = [self.cascade_frontal_alt, self.cascade_profile]
+        if rospy.get_param("~use_alt2", False):
+            self.cascades.append(self.cascade_frontal_alt2)
+        self.cascade_locks = [threading.Lock() for cascade in self.cascades]
+        self.cascade_pool = ThreadPool(len(self.cascades))
+        self.overlap_threshold = rospy.get_param("~overlap_threshold", 0.5)
+        
+        """ face_detection: off, full (whole frame every time) or roi (only
+            around the people found in the depth image, with a full frame
+            scan every full_scan_period frames or when all faces are lost) """
+        self.face_detection = rospy.get_param("~face_detection", "off")
+        self.roi_pad = rospy.get_param("~roi_pad", 40) # pixels
+        self.full_scan_period = rospy.get_param("~full_scan_period", 30) # frames
+        
+        """ scale_prior: only look for faces of about the size a face_width
+            metres wide face has at the depth of each region, within a
+            factor scale_band """
+        self.scale_prior = rospy.get_param("~scale_prior", False)
+        self.face_width = rospy.get_param("~face_width", 0.2) # metres, as boxed by the cascades
+        self.scale_band = rospy.get_param("~scale_band", 1.3)
+        
+        """ With codebook set (a file written by codebook.py) every frame's
+            descriptors are also projected to PCA codes """
+        self.codebook = None
+        if rospy.get_param("~codebook", ""):
+            self.codebook = Codebook(rospy.get_param("~codebook"))
+        
+        """ With gaze_model set (a file written by classifier.py) every face is
+            labelled with its gaze target as it is processed, from its codes
+            if the model was trained on them (classify_codes). Its width has
+            to match either the 400 descriptor cells or the codebook's k. """
+        self.classifier = None
+        self.classify_codes = False
+        if rospy.get_param("~gaze_model", ""):
+            self.classifier = GazeClassifier(rospy.get_param("~gaze_model"))
+            if self.codebook is not None and self.classifier.nFeatures == self.codebook.k:
+                self.classify_codes = True
+            elif self.classifier.nFeatures != 400:
+                expected = "400 (descriptors)"
+                if self.codebook is not None:
+                    expected += " or %d (codes of ~codebook)" % self.codebook.k
+                message = "%s: gaze_model %s takes %d features, expected %s" % (self.node_name,
+                          rospy.get_param("~gaze_model"), self.classifier.nFeatures, expected)
+                rospy.logfatal(message)
+                raise ValueError(message)
+        
+        """ Frames are processed by a pool of workers shared by all streams,
+            the callbacks only hand them over. A stream is queued in ready at
+            most once, so its frames are processed one at a time, in order.
+            The streams subscribe as they are built, so ready exists before
+            them; frames scheduled until the workers start wait in it. """
+        self.ready = Queue.Queue()
+        self.schedule_lock = threading.Lock()
+        
+        """ One stream per camera namespace in streams, or a single one on
+            the node's own input_rgb_image and input_depth_image. The
+            display shows the first stream. """
+        self.streams = [GazeStream(self, namespace) for namespace in rospy.get_param("~streams", [""])]
                         
         """ Wait until the image topics are ready before starting """
-        rospy.wait_for_message(self.input_rgb_image, Image)
-        rospy.wait_for_message(self.input_depth_image, Image)
+        for stream in self.streams:
+            rospy.wait_for_message(stream.input_rgb_image, Image)
+            rospy.wait_for_message(stream.input_depth_image, Image)
             
         rospy.loginfo("Starting " + self.node_name)
+        
+        self.workers = []
+        for i in range(rospy.get_param("~workers", len(self.streams))):
+            worker = threading.Thread(target=self.process_loop)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+        
+        self.diagnostics_timer = rospy.Timer(rospy.Duration(rospy.get_param("~diagnostics_period", 5.0)),
+                                             self.publish_diagnostics)
             
 
-    def detect_faces(self, cv_image):
-        if self.grey is None:
+    def detect_faces(self, stream, cv_image, regions=None, bands=None):
+        """ Run the cascades over regions, a list of (x1, y1, x2, y2) boxes
+            in full resolution pixels, or over the whole frame when regions
+            is None. Only the pixels inside the regions are converted,
+            equalized and downsampled. The cascades run concurrently on
+            cascade_pool and their detections are merged with overlap
+            suppression.
+            
+            bands optionally gives a (smallest, largest) face width in pixels
+            for every region (or None). Such a region is downsampled so that
+            its smallest face fills the smallest cascade window, which leaves
+            only a few scales to scan, and faces outside the band are
+            dropped. """
+        if stream.grey is None:
             """ Allocate temporary images """      
-            self.grey = cv.CreateImage(self.image_size, 8, 1)
+            stream.grey = cv.CreateImage(stream.image_size, 8, 1)
             
-        if self.small_image is None:
-            self.small_image = cv.CreateImage((cv.Round(self.image_size[0] / self.image_scale),
-                       cv.Round(self.image_size[1] / self.image_scale)), 8, 1)
+        if stream.small_image is None:
+            stream.small_image = cv.CreateImage((cv.Round(stream.image_size[0] / self.image_scale),
+                       cv.Round(stream.image_size[1] / self.image_scale)), 8, 1)
 
-        """ Convert color input image to grayscale """
-        cv.CvtColor(cv_image, self.grey, cv.CV_BGR2GRAY)
+        s = self.image_scale
+        if regions is None:
+            regions = [(0, 0, stream.image_size[0] // s * s, stream.image_size[1] // s * s)]
+        if bands is None:
+            bands = [None] * len(regions)
+
+        prepared = []
+        for (x1, y1, x2, y2), band in zip(regions, bands):
+            rect = (x1, y1, x2 - x1, y2 - y1)
+            
+            """ Convert color input image to grayscale """
+            grey = cv.GetSubRect(stream.grey, rect)
+            cv.CvtColor(cv.GetSubRect(cv_image, rect), grey, cv.CV_BGR2GRAY)
         
-        """ Equalize the histogram to reduce lighting effects. """
-        cv.EqualizeHist(self.grey, self.grey)
+            """ Equalize the histogram to reduce lighting effects. """
+            cv.EqualizeHist(grey, grey)
 
-        """ Scale input image for faster processing """
-        cv.Resize(self.grey, self.small_image, cv.CV_INTER_LINEAR)
+            """ Scale input image for faster processing """
+            if band is None:
+                scale = s
+                small = cv.GetSubRect(stream.small_image, (x1 / s, y1 / s, (x2 - x1) / s, (y2 - y1) / s))
+            else:
+                """ Never upsample. The scaled region fits inside the region
+                    itself, so regions that don't overlap never share pixels
+                    of scaled_image. """
+                if stream.scaled_image is None:
+                    stream.scaled_image = cv.CreateImage(stream.image_size, 8, 1)
+                scale = max(1.0, band[0] / float(self.min_size[0]))
+                w, h = int((x2 - x1) / scale), int((y2 - y1) / scale)
+                if w < self.min_size[0] or h < self.min_size[1]:
+                    continue
+                small = cv.GetSubRect(stream.scaled_image, (x1, y1, w, h))
+            cv.Resize(grey, small, cv.CV_INTER_LINEAR)
+            prepared.append((x1, y1, small, scale, band))
 
-        """ First check one of the frontal templates """
-        frontal_faces = cv.HaarDetectObjects(self.small_image, self.cascade_frontal_alt, cv.CreateMemStorage(0),
-                                             self.haar_scale, self.min_neighbors, self.haar_flags, self.min_size)
-                                         
-        """ Now check the profile template """
-        profile_faces = cv.HaarDetectObjects(self.small_image, self.cascade_profile, cv.CreateMemStorage(0),
-                                             self.haar_scale, self.min_neighbors, self.haar_flags, self.min_size)
-
-        """ Lastly, check a different frontal profile """
-        #faces = cv.HaarDetectObjects(self.small_image, self.cascade_frontal_alt2, cv.CreateMemStorage(0),
-        #                                 self.haar_scale, self.min_neighbors, self.haar_flags, self.min_size)
-        #profile_faces.extend(faces)
+        """ The frontal, profile and (with use_alt2) alt2 cascades only read
+            the prepared images, each writes to its own storage """
+        results = [self.cascade_pool.apply_async(self.run_cascade, (i, stream.storages[i], prepared))
+                   for i in range(len(self.cascades))]
+        detections = []
+        for result in results:
+            detections += result.get()
             
         '''if not frontal_faces and not profile_faces:
             if self.show_text:
                 text_font = cv.InitFont(cv.CV_FONT_VECTOR0, 3, 2, 0, 3)
                 cv.PutText(self.marker_image, "NO FACES!", (50, int(self.image_size[1] * 0.9)), text_font, cv.RGB(255, 255, 0))'''
              
-        faces_boxes = []   
-        for ((x, y, w, h), n) in frontal_faces + profile_faces:
-            """ The input to cv.HaarDetectObjects was resized, so scale the 
-                bounding box of each face and convert it to two CvPoints """
-            pt1 = (int(x * self.image_scale), int(y * self.image_scale))
-            pt2 = (int((x + w) * self.image_scale), int((y + h) * self.image_scale))
+        return suppressOverlaps(detections, self.overlap_threshold)
+
+    def run_cascade(self, index, storage, prepared):
+        """ Cascade index over every prepared region, as [(face box, neighbors)] """
+        faces_boxes = []
+        for (x1, y1, small, s, band) in prepared:
+            self.cascade_locks[index].acquire()
+            try:
+                faces = cv.HaarDetectObjects(small, self.cascades[index], storage,
+                                             self.haar_scale, self.min_neighbors, self.haar_flags, self.min_size)
+            finally:
+                self.cascade_locks[index].release()
+            cv.ClearMemStorage(storage)
+            for ((x, y, w, h), n) in faces:
+                """ Sizes the depth says are impossible are false positives """
+                if band is not None and not band[0] <= w * s <= band[1]:
+                    continue
                 
-            face_box = (pt1[0], pt1[1], pt2[0], pt2[1])
-            faces_boxes.append(face_box)
+                """ The input to cv.HaarDetectObjects was resized and cropped, so scale
+                    the bounding box of each face and move it back into the frame """
+                pt1 = (int(x * s) + x1, int(y * s) + y1)
+                pt2 = (int((x + w) * s) + x1, int((y + h) * s) + y1)
+                
+                face_box = (pt1[0], pt1[1], pt2[0], pt2[1])
+                faces_boxes.append((face_box, n))
         return faces_boxes
 
-    def process_faces(self, boxes):     
-        if not self.depth_image: 
+    def detection_regions(self, stream, boxes, bands=None):
+        """ Pad boxes by roi_pad, clip them to the frame, align them to the
+            downsampling grid and merge the ones that overlap, so no pixel is
+            scanned twice. Regions too small to hold min_size are dropped.
+            
+            With bands, a (smallest, largest) face width or None for every
+            box, boxes are padded by half their largest face instead, and
+            (regions, region bands) is returned. A merged region's band
+            covers the bands of all its boxes. """
+        s = self.image_scale
+        width, height = stream.image_size[0] // s * s, stream.image_size[1] // s * s
+        regions = []
+        for i, (x1, y1, x2, y2) in enumerate(boxes):
+            band = bands[i] if bands is not None else None
+            pad = self.roi_pad if band is None else int(band[1] / 2)
+            regions.append([max(0, int(x1) - pad) // s * s, max(0, int(y1) - pad) // s * s,
+                            min(width, -(-(int(x2) + pad) // s) * s), min(height, -(-(int(y2) + pad) // s) * s),
+                            band])
+        
+        merged = True
+        while merged:
+            merged = False
+            for i in range(len(regions)):
+                for j in range(i + 1, len(regions)):
+                    a, b = regions[i], regions[j]
+                    if a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+                        band = None
+                        if a[4] is not None and b[4] is not None:
+                            band = (min(a[4][0], b[4][0]), max(a[4][1], b[4][1]))
+                        regions[i] = [min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]), band]
+                        del regions[j]
+                        merged = True
+                        break
+                if merged:
+                    break
+        
+        regions = [r for r in regions
+                   if r[2] - r[0] >= self.min_size[0] * s and r[3] - r[1] >= self.min_size[1] * s]
+        if bands is None:
+            return [tuple(r[:4]) for r in regions]
+        return [tuple(r[:4]) for r in regions], [r[4] for r in regions]
+
+    def detect_faces_guided(self, stream, cv_image, depth_boxes):
+        """ Face detection restricted to the people found in the depth image.
+            The cascades only run around the depth boxes and last frame's
+            detections. Every full_scan_period frames, and whenever the
+            previous frame lost all its detections or there is nothing to look
+            around, the whole frame is scanned instead. With scale_prior the
+            median depth of every box limits the face sizes looked for
+            around it. """
+        stream.detect_count += 1
+        
+        boxes = list(depth_boxes) + stream.prev_detections
+        if self.scale_prior:
+            bands = [sizeBand(stream.depth_image, box, self.scale_band, self.face_width) for box in boxes]
+            regions, bands = self.detection_regions(stream, boxes, bands)
+        else:
+            regions, bands = self.detection_regions(stream, boxes), None
+        full_scan = (self.face_detection == 'full' or not regions or stream.tracks_lost or
+                     stream.detect_count % self.full_scan_period == 0)
+        if full_scan:
+            detections = self.detect_faces(stream, cv_image)
+        else:
+            detections = self.detect_faces(stream, cv_image, regions, bands)
+        
+        stream.tracks_lost = bool(stream.prev_detections) and not detections
+        stream.prev_detections = detections
+        return detections
+
+    def process_faces(self, stream, boxes):     
+        if stream.depth_image is None: 
             print 'whoops! no depth image!'
             return
           
-        skip = 1
-        xyz_all = []
-        
-        idNum = 1
-        #f = open("output.dat","w")
-        boxNum = 1
-        prevV = None
-        for (x1,y1,x2,y2) in boxes:
+        """ The face cloud of this frame, projected as the boxes ask for it """
+        if stream.cloud is None or stream.cloud.rays is not stream.rays:
+            stream.cloud = OrganizedCloud(stream.rays)
+        cloud = stream.cloud
+        cloud.reset(stream.depth_image)
+        
+        indices = []
+        labels = []
+        segments = [] # (boxNum, colorFlag) for every (box, padding) pair
+        
+        for boxNum, (x1,y1,x2,y2) in enumerate(boxes):
             x1, y1, x2, y2 = cv.Round(x1), cv.Round(y1), cv.Round(x2), cv.Round(y2)
             for xpad, ypad, ypad2 in zip([10,10],[40,40],[40,0]):
 
@@ -171,75 +571,41 @@ class Gaze:
                 else:
                     colorFlag = 1
 
-                u,v = np.mgrid[y1-ypad:y2+ypad2:skip,x1-xpad:x2+xpad:skip]
-                u,v = u.flatten(), v.flatten()
-                d = np.asarray(self.depth_image[y1-ypad:y2+ypad2,x1-xpad:x2+xpad])
-                d = d[::skip,::skip]
-                d = d.flatten()
-                
-                u = u[np.isfinite(d)]
-                v = v[np.isfinite(d)]
-                d = d[np.isfinite(d)]
-                
-                ### only if from dat, bad value should actually be 2047
-                u = u[d!=0]
-                v = v[d!=0]
-                d = d[d!=0]
-                
-                #u = u[d < alpha*median]
-                #v = v[d < alpha*median] 
-                #d = d[d < alpha*median]
-                
-                xyz = self.makeCloud_correct(u,v,d)
-                
-                '''median = sorted(xyz[:,2])[len(d)//2]
-                alpha = 1.2
-                xyz = xyz[xyz[:,2] < alpha*median,:]'''
-                
-                xyz_all.extend(xyz)
-                
-                try:
-                    n = len(xyz)
-                    mu = np.sum(xyz, axis=0)/n
-                    xyz_norm = xyz - mu
-                    cov = np.dot(xyz_norm.T, xyz_norm)/n
-                    e, v = eig(cov)
-                    
-                    #print v[2]
-                    
-                    if v[2][2] > 0: v[2] = -v[2]
-                    
-                    # publish marker here
-                    if colorFlag == 1:
-                        m = self.makeMarker(mu, v[2], idNum=idNum, color=(1,0,0))
-                        print '%d %f %f %f' % (boxNum, v[2][0], v[2][1], v[2][2]),
-                    else:
-                        m = self.makeMarker(mu, v[2], idNum=idNum, color=(0,1,0))
-                        print '%f %f %f ' % (v[2][0], v[2][1], v[2][2])
-                    idNum += 1
-                    self.pubFaceNormals.publish(m)
-                except:
-                    pass
-            boxNum += 1
+                """ Valid (non zero, finite) points of the padded box """
+                idx = cloud.indices((x1-xpad, y1-ypad, x2+xpad, y2+ypad2))
+                indices.append(idx)
+                labels.append(np.repeat(len(segments), len(idx)))
+                segments.append((boxNum+1, colorFlag))
+        
+        """ One copy out of the organized cloud for the normals and the published cloud,
+            then fit a plane to every (box, padding) segment at once """
+        xyz_all = np.zeros((0, 3), dtype=np.float32)
+        if segments:
+            xyz_all = cloud.points(np.concatenate(indices))
+            mu, normals, valid = estimateNormals(xyz_all, np.concatenate(labels), len(segments))
+        
+        for k, (boxNum, colorFlag) in enumerate(segments):
+            if not valid[k]:
+                rospy.logwarn("face %d: degenerate point cloud, no normal estimated" % boxNum)
+                continue
+            n = normals[k]
+            
+            # marker ids follow the face, so a face's arrows are updated in place
+            if colorFlag == 1:
+                stream.normalMarkers.arrow(2*boxNum-1, mu[k], n, color=(1,0,0))
+                print '%d %f %f %f' % (boxNum, n[0], n[1], n[2]),
+            else:
+                stream.normalMarkers.arrow(2*boxNum, mu[k], n, color=(0,1,0))
+                print '%f %f %f ' % (n[0], n[1], n[2])
           
-        # getting rid of bad markers in rviz by sending them away  
-        for blah in range(idNum,25):
-            m = self.makeMarker([-10,-10,-10], [1,1,1], idNum=idNum, color=(1,1,1))
-            idNum += 1
-            self.pubFaceNormals.publish(m)
+        # one message with the arrows that changed; arrows of faces that are gone are deleted
+        stream.normalMarkers.publish()
 
         pc = PointCloud2()
         pc.header.frame_id = "/camera_rgb_optical_frame"
         pc.header.stamp = rospy.Time()
-        pc = create_cloud_xyz32(pc.header, xyz_all)
-        self.pubFaceCloud.publish(pc)
-        
-    def display_markers(self):
-        # If the user is selecting a region with the mouse, display the corresponding rectangle for feedback.
-        if self.drag_start and self.is_rect_nonzero(self.selection):
-            x,y,w,h = self.selection
-            cv.Rectangle(self.display_image, (x, y), (x + w, y + h), (0, 255, 255), 2)
-            self.selected_point = None
+        pc = create_cloud_xyz32_array(pc.header, xyz_all)
+        stream.pubFaceCloud.publish(pc)
         
     def is_rect_nonzero(self, r):
         # First assume a simple CvRect type
@@ -255,11 +621,12 @@ class Gaze:
     def on_mouse_click(self, event, x, y, flags, param):
         """ We will usually use the mouse to select points to track or to draw a rectangle
             around a region of interest. """
-        if not self.image:
+        image = self.streams[0].image
+        if not image:
             return
         
-        if self.image.origin:
-            y = self.image.height - y
+        if image.origin:
+            y = image.height - y
             
         if event == cv.CV_EVENT_LBUTTONDOWN and not self.drag_start:
             self.detect_box = None
@@ -276,83 +643,132 @@ class Gaze:
         if self.drag_start:
             xmin = max(0, min(x, self.drag_start[0]))
             ymin = max(0, min(y, self.drag_start[1]))
-            xmax = min(self.image.width, max(x, self.drag_start[0]))
-            ymax = min(self.image.height, max(y, self.drag_start[1]))
+            xmax = min(image.width, max(x, self.drag_start[0]))
+            ymax = min(image.height, max(y, self.drag_start[1]))
             self.selection = (xmin, ymin, xmax - xmin, ymax - ymin)
             
-    def depth_callback(self, data):
-        depth_image = self.convert_depth_image(data)
-            
-        if not self.depth_image:
-            (cols, rows) = cv.GetSize(depth_image)
-            self.depth_image = cv.CreateMat(rows, cols, cv.CV_16UC1) # cv.CV_32FC1
-            
-        cv.Copy(depth_image, self.depth_image)
+    def schedule(self, stream):
+        """ Queue stream for a worker, unless it is queued or being processed """
+        self.schedule_lock.acquire()
+        try:
+            if not stream.scheduled:
+                stream.scheduled = True
+                self.ready.put(stream)
+        finally:
+            self.schedule_lock.release()
+        
+    def process_loop(self):
+        while not rospy.is_shutdown():
+            try:
+                stream = self.ready.get(timeout=0.1)
+            except Queue.Empty:
+                continue
+            """ A bad frame is logged and skipped, like rospy does for a callback,
+                and the stream is always released for the next one """
+            try:
+                frame = stream.frame_slot.get(timeout=0)
+                if frame is not None:
+                    self.process_frame(stream, *frame)
+            except Exception, e:
+                rospy.logerr("%s: error processing frame: %s\n%s" % (stream.name, e, traceback.format_exc()))
+            finally:
+                """ A frame that arrived meanwhile couldn't queue the stream again """
+                self.schedule_lock.acquire()
+                try:
+                    stream.scheduled = stream.frame_slot.full
+                    if stream.scheduled:
+                        self.ready.put(stream)
+                finally:
+                    self.schedule_lock.release()
 
-    def image_callback(self, data):       
+    def process_frame(self, stream, data, depth_msg):
         start = time.time()
     
+        timer = laps(self.profiler)
+    
         """ Convert the raw image to OpenCV format using the convert_image() helper function """
         cv_image = self.convert_image(data)
+        timer.lap('convert.image')
           
-        """ Create a few images we will use for display """
-        if not self.image:
-            self.image_size = cv.GetSize(cv_image)
-            self.image = cv.CreateImage(self.image_size, 8, 3)
-            self.display_image = cv.CreateImage(self.image_size, 8, 3)
+        """ The stream keeps a copy of its latest frame """
+        if not stream.image:
+            stream.image_size = cv.GetSize(cv_image)
+            stream.image = cv.CreateImage(stream.image_size, 8, 3)
 
 
-        """ Copy the current frame to the global image in case we need it elsewhere"""
-        cv.Copy(cv_image, self.image)
-        
-        #cv.Copy(cv_image, self.display_image)
+        """ Copy the current frame to the stream's image in case we need it elsewhere"""
+        cv.Copy(cv_image, stream.image)
         
         #faces = self.detect_faces(cv_image)
         #faces = self.selections #((148,140,216,224),(424,166,500,238),(276,150,350,234))
         
         
         
-        if not self.depth_image: 
-            print 'no depth image'
-            return
-            
-        
-        if np.all(np.asarray(self.depth_image) == self.prevDepth):
-            return
-            
-        self.prevDepth = np.asarray(self.depth_image).copy()
-        
-        np_image = np.asarray(cv_image).copy()
-        np_depth = np.asarray(self.depth_image).copy()
-        depth_im = cv.fromarray(np_depth)
+        """ Neither may be written to: cv_image wraps the data of the RGB
+            message and the depth is a view of depth_msg or a buffer this
+            frame owns """
+        np_image = np.asarray(cv_image)
+        np_depth = stream.acquire_depth(depth_msg)
+        stream.depth_image = np_depth
+        timer.lap('convert.depth')
         #np_depth[np_depth > 2000] = 0
     
         faces = []
         
-        if self.seeds is None:
-            faces, centroids = dxySegment(np_depth, nClusters=self.clusters, skip=1)
-            self.seeds = centroids
+        if stream.seeds is None:
+            faces, centroids, labels = dxySegmentSparse(np_depth, nClusters=stream.clusters, skip=1, engine='histogram', profiler=self.profiler)
+            stream.seeds = centroids
         else:
-            faces, centroids = dxySegment(np_depth, seeds=self.seeds, skip=1)
-            self.seeds = centroids
+            faces, centroids, labels = dxySegmentSparse(np_depth, seeds=stream.seeds, skip=1, engine='histogram', profiler=self.profiler)
+            stream.seeds = centroids
+        timer = laps(self.profiler)
+        
+        detections = []
+        if self.face_detection != "off":
+            detections = self.detect_faces_guided(stream, cv_image, faces)
+            timer.lap('detect')
             
-        for faceNum, face in enumerate(sorted(faces)):
-            # step 1: extract depth image according to face box
-            x1, y1, x2, y2 = face
-            #if x1 > x2: x2, x1 = x1, x2
-            #if y1 > y2: y2, y1 = y1, y2
+        # step 1: extract depth image according to face box
+        faces = sorted(faces)
+        for x1, y1, x2, y2 in faces:
             print x1, x2, y1, y2
-            face_cropped = depth_im[y1:y2,x1:x2]
-            f_cropped_rgb = cv_image[y1:y2,x1:x2]
-            cv.ShowImage('face box', f_cropped_rgb)
-            
-            # step 2: resize depth image into 20x20
-            face_small = cv.CreateMat(20, 20, cv.CV_16UC1)
-            cv.Resize(face_cropped, face_small)
-            
-            # step 3: output feature vector as flattened (400-dimensional) array
-            self.featureFile.write(str(faceNum+1) + '\t' + '\t'.join([str(x) for x in np.asarray(face_small).flatten()]) + '\n')
-            print str(faceNum+1) + '\t' + '\t'.join([str(x) for x in np.asarray(face_small).flatten()[:7]])
+        
+        # step 2: resize every face's depth into 20x20, one row per face
+        if len(faces) > len(stream.descriptors):
+            stream.descriptors = np.empty((len(faces), 400), dtype=np.uint16)
+        stream.faceDescriptors = faceDescriptors(np_depth, faces, out=stream.descriptors[:len(faces)])
+        timer.lap('crop_resize')
+        
+        # step 2b: project the descriptors to k-dimensional codes
+        if self.codebook is not None:
+            if len(faces) > len(stream.codes):
+                stream.codes = np.empty((len(faces), self.codebook.k), dtype=np.float32)
+            stream.faceCodes = self.codebook.project(stream.faceDescriptors, out=stream.codes[:len(faces)])
+            timer.lap('project')
+        
+        # step 3: output feature vectors as flattened (400-dimensional) arrays
+        if stream.feature_format == "text":
+            for faceNum, face_small in enumerate(stream.faceDescriptors):
+                stream.featureFile.write(featureRow(faceNum+1, face_small))
+        elif stream.feature_format == "codes":
+            stream.featureFile.writeFaces(stream.faceCodes, depth_msg.header.stamp.to_sec(), stream.frameNum)
+        else:
+            stream.featureFile.writeFaces(stream.faceDescriptors, depth_msg.header.stamp.to_sec(), stream.frameNum)
+        timer.lap('feature_write')
+        
+        # step 4: classify every face's gaze target at once
+        if self.classifier is not None:
+            if self.classify_codes:
+                stream.publish_targets(self.classifier.labels(stream.faceCodes))
+            else:
+                stream.publish_targets(self.classifier.labels(stream.faceDescriptors))
+            timer.lap('classify')
+        
+        # step 5: face cloud and normals
+        if stream.publish_normals:
+            self.process_faces(stream, faces)
+            timer.lap('normals')
+        stream.frameNum += 1
         
         """ Process the image to detect and track objects or features """
         '''if self.depthFrameNum == self.prevFrameNum: 
@@ -377,54 +793,52 @@ class Gaze:
             self.prev = curr.copy()
             self.prev_img = np.asarray(cv_image)
             self.prevFrameNum = self.depthFrameNum
-            self.process_faces(faces)'''
+            self.process_faces(stream, faces)'''
             
 
-        #self.mask = cv.CreateImage(self.image_size, 8, 1)  
-        #self.display_image = cv.CreateImage(self.image_size, 8, 3) 
-        #cv.Set(self.display_image,0)         
-        #cv.CmpS(cv.fromarray(np.asarray(self.depth_image).astype(np.uint8)), 0, self.mask, cv.CV_CMP_NE)
-        #cv.CmpS(self.depth_image, 0, self.mask, cv.CV_CMP_NE)
-        #cv.Copy(cv_image, self.display_image, mask=self.mask)
-        
-        #np_image[np_depth == 0] = 0
-        self.display_image = cv.fromarray(np_image)
-            
-        for pl, (x,y,x2,y2) in enumerate(sorted(faces)):
-            cv.Rectangle(self.display_image, (cv.Round(x), cv.Round(y)),
-                                             (cv.Round(x2), cv.Round(y2)), 
-                                             cv.RGB(255, pl*50, 0), 2, 8, 0)
+        self.profiler.add('frame', time.time() - start)
+        stream.frame_done()
         
-        """ Handle keyboard events """
-        self.keystroke = cv.WaitKey(2)
-            
-        end = time.time()
-        duration = end - start
-        fps = int(1.0 / duration)
-        self.cps_values.append(fps)
-        if len(self.cps_values) > self.cps_n_values:
-            self.cps_values.pop(0)
-        self.cps = int(sum(self.cps_values) / len(self.cps_values))
-        
-        if self.show_text:
-            text_font = cv.InitFont(cv.CV_FONT_VECTOR0, 1, 1, 0, 2, 8)
-            """ Print cycles per second (CPS) and resolution (RES) at top of the image """
-            cv.PutText(self.display_image, "FPS: " + str(self.cps), (10, int(self.image_size[1] * 0.1)), text_font, cv.RGB(255, 255, 0))
-            #cv.PutText(self.display_image, "RES: " + str(self.image_size[0]) + "X" + str(self.image_size[1]), (int(self.image_size[0] * 0.6), int(self.image_size[1] * 0.1)), text_font, cv.RGB(255, 255, 0))
-            
-        #self.display_markers()
+        """ Drawing happens on the display thread, on its own copy of np_image """
+        if stream is self.streams[0]:
+            self.display.show(np_image, sorted(faces), stream.cps, detections)
 
-        # Now display the image.
-        cv.ShowImage(self.node_name, self.display_image)
-        
+    def publish_diagnostics(self, event=None):
+        """ One DiagnosticStatus per stage, WARN when its p95 exceeds the frame budget """
+        budget = 1000.0 * self.frame_budget
+        msg = DiagnosticArray()
+        msg.header.stamp = rospy.Time.now()
+        for name, s in self.profiler.summary():
+            status = DiagnosticStatus()
+            status.name = "%s: %s" % (self.node_name, name)
+            status.hardware_id = self.node_name
+            status.level = DiagnosticStatus.WARN if s['p95'] > budget else DiagnosticStatus.OK
+            status.message = "p50 %.1f ms, p95 %.1f ms, p99 %.1f ms" % (s['p50'], s['p95'], s['p99'])
+            status.values = [KeyValue(k, "%.3f" % s[k]) for k in ('count', 'mean', 'p50', 'p95', 'p99', 'max')]
+            msg.status.append(status)
+        
+        """ And one per stream with its throughput and dropped frames """
+        for stream in self.streams:
+            status = DiagnosticStatus()
+            status.name = "%s: stream %s" % (self.node_name, stream.name)
+            status.hardware_id = self.node_name
+            status.level = DiagnosticStatus.OK
+            status.message = "%.1f fps, dropped %d of %d frames" % (stream.throughput(), stream.frame_slot.dropped,
+                                                                    stream.frame_slot.put_count)
+            status.values = [KeyValue("fps", "%.2f" % stream.throughput()),
+                             KeyValue("frames", str(stream.frameNum)),
+                             KeyValue("dropped", str(stream.frame_slot.dropped))]
+            if stream.publish_normals:
+                status.values += [KeyValue("marker messages", str(stream.normalMarkers.sent)),
+                                  KeyValue("markers sent", str(stream.normalMarkers.entries))]
+            msg.status.append(status)
+        self.pubDiagnostics.publish(msg)
+
+    def on_key(self, cc):
         """ Process any keyboard commands """
-        if 32 <= self.keystroke and self.keystroke < 128:
-            cc = chr(self.keystroke).lower()
-            if cc == 't':
-                self.show_text = not self.show_text
-            elif cc == 'q':
-                """ user has press the q key, so exit """
-                rospy.signal_shutdown("User hit q key to quit.")      
+        if cc == 'q':
+            """ user has press the q key, so exit """
+            rospy.signal_shutdown("User hit q key to quit.")      
 
     def convert_image(self, ros_image):
         try:
@@ -433,6 +847,40 @@ class Gaze:
         except CvBridgeError, e:
           print e
           
+    def depth_in_place(self, ros_image):
+        """ Whether convert_depth_array can view the depth of ros_image without decoding it """
+        return ros_image.encoding in DEPTH_MM_ENCODINGS and bool(ros_image.is_bigendian) == (sys.byteorder == 'big')
+    
+    def convert_depth_array(self, ros_image, out=None):
+        """ View a 16UC1 (millimetre) depth message as a (rows, cols) array without
+            copying, in the byte order of the message, or decode it into out, a
+            native uint16 buffer of that shape. 32FC1 depth in metres, as
+            depth_image_proc/convert_metric publishes it, is always decoded, to
+            millimetres with 0 where it is NaN """
+        if ros_image.encoding in DEPTH_MM_ENCODINGS:
+            dtype = np.dtype('>u2' if ros_image.is_bigendian else '<u2')
+        elif ros_image.encoding == '32FC1':
+            dtype = np.dtype('>f4' if ros_image.is_bigendian else '<f4')
+        else:
+            raise ValueError("unsupported depth encoding '%s' on %s, expected 16UC1 (mm) or 32FC1 (m)"
+                             % (ros_image.encoding, ros_image.header.frame_id))
+        row = ros_image.step // dtype.itemsize
+        depth = np.frombuffer(ros_image.data, dtype=dtype, count=ros_image.height * row)
+        depth = depth.reshape(ros_image.height, row)[:, :ros_image.width]
+        if dtype.kind == 'f':
+            millimetres = depth * np.float32(1000)
+            millimetres[~np.isfinite(millimetres)] = 0
+            np.clip(millimetres, 0, 65535, millimetres)
+            if out is None:
+                out = np.empty(depth.shape, dtype=np.uint16)
+            np.rint(millimetres, out=millimetres)
+            out[...] = millimetres
+            return out
+        if out is not None:
+            out[...] = depth
+            return out
+        return depth
+    
     def convert_depth_image(self, ros_image):
         try:
             
@@ -448,68 +896,30 @@ class Gaze:
         # only if from dat
         #d = 1000.0 * .1236 * np.tan((d / 2842.5) + 1.1863) - 0.0370
         
-        const = .001/575.8157348632812
-        
-        xp = d*const*(v-314.5)
-        yp = d*const*(u-235.5)
-        zp = d*0.001
-        
-        return np.vstack((xp,yp,zp)).T
+        return self.rays.projectPoints(u, v, d)
             
     def makeCloud(self, u, v, d): # for depth values, from pi_vision
-        xyz = []
-        C = np.vstack((u.flatten(), v.flatten(), d.flatten()))  
-
-        for i in range(C.shape[1]):
-            
-            y, x, z = C[0,i], C[1,i], C[2,i]
-            
-            zp = z #1.0 / (z * -0.0030711016 + 3.3309495161)
-            #print z, zp
-            
-            #550,.1 or 0,600 (saw 0,603.3)
-            xp = (zp-.0) * 1.094 * (x - 640 / 2.0) / float(603.3) 
-            yp = (zp-.0) * 1.094 * (y - 480 / 2.0) / float(603.3) #550
-            
-            if not np.isnan(xp) and not np.isnan(yp) and not np.isnan(zp):
-                xyz.append((xp,yp,zp))
-        return xyz
-                    
+        #550,.1 or 0,600 (saw 0,603.3)
+        rays = rayTable(640, 480, 603.3 / 1.094, 603.3 / 1.094, 640 / 2.0, 480 / 2.0, 1.0)
+        xyz = rays.projectPoints(u.flatten(), v.flatten(), d.flatten())
+        return xyz[np.isfinite(xyz).all(axis=1)]
 
-    
     def makeMarker(self, pos, vec, idNum=1, color=(1,0,0)):
-        m = Marker()
-        m.id = idNum
-        m.ns = "test"
-        m.header.frame_id = "/camera_rgb_optical_frame"
-        m.type = Marker.ARROW
-        m.action = Marker.ADD
-        
-        markerPt1 = Point()
-        markerPt2 = Point()
-        markerPt1.x = pos[0];
-        markerPt1.y = pos[1];
-        markerPt1.z = pos[2];
-        markerPt2.x = markerPt1.x + vec[0];
-        markerPt2.y = markerPt1.y + vec[1];
-        markerPt2.z = markerPt1.z + vec[2];
-        
-        m.points = [markerPt1, markerPt2]
-        
-        m.scale.x = .1;
-        m.scale.y = .1;
-        m.scale.z = .1;
-        m.color.a = 1;
-        m.color.r = color[0];
-        m.color.g = color[1];
-        m.color.b = color[2];
-        #m.lifetime = rospy.Duration()
-        return m
+        return arrowMarker(pos, vec, idNum, color)
         
     def cleanup(self):
         print "Shutting down vision node."
-        self.featureFile.close()
-        cv.DestroyAllWindows()  
+        for worker in self.workers:
+            worker.join(1.0)
+        for stream in self.streams:
+            print "%s: %d frames, %.1f fps, dropped %d of %d." % (stream.name, stream.frameNum, stream.throughput(),
+                                                                 stream.frame_slot.dropped, stream.frame_slot.put_count)
+            stream.close()
+        self.cascade_pool.close()
+        print self.profiler.report()
+        if self.profile_file:
+            self.profiler.dump(self.profile_file)
+        self.display.stop()
     
 def main(args):
     """ Display a help message if appropriate """
@@ -91,6 +91,107 @@ def lk(It, It1, rect, graphics=False):
 
     return u, v
     
+def _window(img, x0, y0, w, h):
+    ''' Bilinearly sample the w x h window of img whose top left corner is at
+        the (sub-pixel) position x0, y0. Returns None if it falls outside. '''
+    ix, iy = int(np.floor(x0)), int(np.floor(y0))
+    if ix < 0 or iy < 0 or ix+w+1 > img.shape[1] or iy+h+1 > img.shape[0]:
+        return None
+    fx, fy = x0 - ix, y0 - iy
+    a = img[iy:iy+h+1, ix:ix+w+1]
+    top = (1-fx)*a[:-1,:-1] + fx*a[:-1,1:]
+    bottom = (1-fx)*a[1:,:-1] + fx*a[1:,1:]
+    return (1-fy)*top + fy*bottom
+
+def _pyramid(img, levels):
+    pyr = [img]
+    for l in range(1, levels):
+        im = pyr[-1]
+        h, w = im.shape[0]//2*2, im.shape[1]//2*2
+        if h < 2 or w < 2:
+            break
+        im = im[:h,:w]
+        pyr.append(0.25*(im[0::2,0::2] + im[1::2,0::2] + im[0::2,1::2] + im[1::2,1::2]))
+    return pyr
+
+def lkPyramid(It, It1, rects, levels=3, maxIter=20, eps=0.01, margin=16, minSize=6):
+    ''' Translation-only inverse compositional Lucas-Kanade, coarse to fine.
+
+        Tracks every rect (x1, y1, x2, y2) of It into It1 and returns a list
+        of (u, v) displacements, (0, 0) where tracking failed, matching lk().
+        Only a window of +/- margin pixels around each rect is converted and
+        pyramided, and the template gradients and Hessian are computed once
+        per level, so an iteration is one bilinear resample of the target.
+
+        Not called by the node yet: tracking in Gaze.process_frame is still
+        commented out. On the It_depth.dat/It2_depth.dat face it has measured
+        0.6-1.0 ms (best/median) and up to 1.4 ms elsewhere, so not reliably
+        under 1 ms, against 8-13 ms for lk(); benchmark.py times both. '''
+    It = np.asarray(It)
+    It1 = np.asarray(It1)
+    rows, cols = It.shape[:2]
+
+    results = []
+    for rect in rects:
+        x1, y1, x2, y2 = [int(round(c)) for c in rect]
+        ox, oy = max(0, x1-margin), max(0, y1-margin)
+        ex, ey = min(cols, x2+margin), min(rows, y2+margin)
+        if x2-x1 < 2 or y2-y1 < 2 or ex-ox < 2 or ey-oy < 2:
+            results.append((0, 0))
+            continue
+
+        # don't go coarser than a minSize template
+        nLevels = 1
+        while nLevels < levels and min(x2-x1, y2-y1) >> nLevels >= minSize:
+            nLevels += 1
+
+        T_pyr = _pyramid(np.asarray(It[oy:ey, ox:ex], dtype=np.float32), nLevels)
+        I_pyr = _pyramid(np.asarray(It1[oy:ey, ox:ex], dtype=np.float32), nLevels)
+        nLevels = min(len(T_pyr), len(I_pyr))
+
+        u, v = 0.0, 0.0
+        lost = False
+        for l in reversed(range(nLevels)):
+            s = 2.0**l
+            u, v = u/s, v/s
+            # pixel centres map as (x + 0.5)/s - 0.5 between levels
+            tx, ty = (x1-ox+0.5)/s - 0.5, (y1-oy+0.5)/s - 0.5
+            tw, th = max(2, int(round((x2-x1)/s))), max(2, int(round((y2-y1)/s)))
+
+            T = _window(T_pyr[l], tx, ty, tw, th)
+            if T is None:
+                lost = True
+                break
+
+            # template gradient and Hessian, once per level
+            Ty, Tx = np.gradient(T)
+            H = np.array([[np.sum(Tx*Tx), np.sum(Tx*Ty)],
+                          [np.sum(Tx*Ty), np.sum(Ty*Ty)]])
+            det = H[0,0]*H[1,1] - H[0,1]*H[1,0]
+            if det <= 1e-9 * max(H[0,0]*H[1,1], 1e-30):
+                lost = True
+                break
+            Hinv = np.array([[H[1,1], -H[0,1]], [-H[1,0], H[0,0]]]) / det
+
+            for it in range(maxIter):
+                I = _window(I_pyr[l], tx+u, ty+v, tw, th)
+                if I is None:
+                    lost = True
+                    break
+                err = I - T
+                du, dv = np.dot(Hinv, [np.sum(Tx*err), np.sum(Ty*err)])
+                # inverse composition of a translation is a subtraction
+                u -= du
+                v -= dv
+                if du*du + dv*dv < eps*eps:
+                    break
+            if lost:
+                break
+            u, v = u*s, v*s
+
+        results.append((0, 0) if lost else (u, v))
+    return results
+
 if __name__ == '__main__':
     rect = (369, 135, 408, 190)
     
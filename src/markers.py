@@ -0,0 +1,99 @@
+''' Face normal arrows for rviz, published as one MarkerArray per frame.
+
+    A MarkerCache remembers what rviz is already showing. Every frame only
+    the arrows that appeared or moved are sent (rviz treats ADD of a known id
+    as a modify), and the ones that are gone are DELETEd, instead of one
+    Marker message per arrow plus dummies parked off screen.
+'''
+import rospy
+from visualization_msgs.msg import MarkerArray, Marker
+from geometry_msgs.msg import Point
+
+def arrowMarker(pos, vec, idNum=1, color=(1,0,0), ns="test", frame_id="/camera_rgb_optical_frame"):
+    ''' ARROW marker from pos along vec. '''
+    m = Marker()
+    m.id = idNum
+    m.ns = ns
+    m.header.frame_id = frame_id
+    m.type = Marker.ARROW
+    m.action = Marker.ADD
+    m.points = [Point(), Point()]
+    m.scale.x = .1
+    m.scale.y = .1
+    m.scale.z = .1
+    m.color.a = 1
+    setArrow(m, pos, vec, color)
+    return m
+
+def setArrow(m, pos, vec, color):
+    m.points[0].x, m.points[0].y, m.points[0].z = pos[0], pos[1], pos[2]
+    m.points[1].x, m.points[1].y, m.points[1].z = pos[0] + vec[0], pos[1] + vec[1], pos[2] + vec[2]
+    m.color.r, m.color.g, m.color.b = color
+
+class MarkerCache:
+    ''' Arrows of one publisher. Call arrow() for every arrow of a frame, then
+        publish(). An arrow is resent when either end moved more than
+        tolerance metres or its color changed, and everything is resent every
+        refresh frames (0 for never) so a late rviz catches up. '''
+    def __init__(self, publisher, ns="test", frame_id="/camera_rgb_optical_frame", tolerance=0.01, refresh=30):
+        self.publisher = publisher
+        self.ns = ns
+        self.frame_id = frame_id
+        self.tolerance = tolerance
+        self.refresh = refresh
+        self.shown = {}   # id: (pos, end, color) as rviz has it
+        self.markers = {} # id: Marker, reused from frame to frame
+        self.frame = {}   # id: (pos, end, color) of the frame being built
+        self.frameNum = 0
+        self.sent = 0     # MarkerArray messages
+        self.entries = 0  # Markers in them
+
+    def arrow(self, idNum, pos, vec, color=(1,0,0)):
+        pos = (float(pos[0]), float(pos[1]), float(pos[2]))
+        end = (pos[0] + float(vec[0]), pos[1] + float(vec[1]), pos[2] + float(vec[2]))
+        self.frame[idNum] = (pos, end, tuple(color))
+
+    def changed(self, old, new):
+        if old is None or old[2] != new[2]:
+            return True
+        return max([abs(a - b) for a, b in zip(old[0] + old[1], new[0] + new[1])]) > self.tolerance
+
+    def publish(self, stamp=None):
+        ''' Send the changes since the last frame, if there are any. Returns
+            the number of markers sent. '''
+        self.frameNum += 1
+        resend = self.refresh > 0 and self.frameNum % self.refresh == 0
+        stamp = stamp or rospy.Time()
+        ma = MarkerArray()
+        ma.markers = []
+        for idNum, state in sorted(self.frame.items()):
+            if not resend and not self.changed(self.shown.get(idNum), state):
+                continue
+            pos, end, color = state
+            if idNum in self.markers:
+                m = self.markers[idNum]
+                m.action = Marker.ADD
+                setArrow(m, pos, [e - p for e, p in zip(end, pos)], color)
+            else:
+                m = self.markers[idNum] = arrowMarker(pos, [e - p for e, p in zip(end, pos)], idNum, color,
+                                                      self.ns, self.frame_id)
+            m.header.stamp = stamp
+            self.shown[idNum] = state
+            ma.markers.append(m)
+        for idNum in sorted(set(self.shown) - set(self.frame)):
+            m = self.markers[idNum]
+            m.action = Marker.DELETE
+            m.header.stamp = stamp
+            del self.shown[idNum]
+            ma.markers.append(m)
+        self.frame = {}
+        if ma.markers:
+            self.publisher.publish(ma)
+            self.sent += 1
+            self.entries += len(ma.markers)
+        return len(ma.markers)
+
+    def clear(self):
+        ''' DELETE everything shown. '''
+        self.frame = {}
+        self.publish()
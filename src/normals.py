@@ -0,0 +1,64 @@
+import numpy as np
+
+# index pairs of the 6 unique entries of a symmetric 3x3 matrix
+_TRIU = [(0,0), (0,1), (0,2), (1,1), (1,2), (2,2)]
+
+def segmentMoments(xyz, labels, nSegments):
+    ''' First and second moments of every labelled segment of xyz in one pass.
+        xyz is (N,3), labels is (N,) with values in [0, nSegments); points
+        with a negative label are ignored. Returns counts (K,), means (K,3)
+        and covariances (K,3,3). '''
+    xyz = np.asarray(xyz, dtype=np.float64).reshape(-1, 3)
+    labels = np.asarray(labels).ravel()
+    keep = labels >= 0
+    if not np.all(keep):
+        xyz, labels = xyz[keep], labels[keep]
+
+    counts = np.bincount(labels, minlength=nSegments)[:nSegments].astype(np.float64)
+    n = np.maximum(counts, 1)
+
+    sums = np.empty((nSegments, 3))
+    for i in range(3):
+        sums[:,i] = np.bincount(labels, weights=xyz[:,i], minlength=nSegments)[:nSegments]
+    mu = sums / n[:,None]
+
+    # second moments about the segment mean, so that points far from the
+    # camera don't lose precision to cancellation
+    centered = xyz - mu[labels]
+    cov = np.empty((nSegments, 3, 3))
+    for i, j in _TRIU:
+        c = np.bincount(labels, weights=centered[:,i]*centered[:,j], minlength=nSegments)[:nSegments] / n
+        cov[:,i,j] = c
+        cov[:,j,i] = c
+
+    return counts, mu, cov
+
+def estimateNormals(xyz, labels, nSegments, minPoints=10, minRatio=1e-6):
+    ''' PCA plane normal of every labelled segment of xyz, solved with a single
+        batched symmetric eigendecomposition. Normals are oriented towards the
+        camera (negative z).
+
+        Returns (mu, normals, valid). valid is False for degenerate segments:
+        fewer than minPoints points, non-finite moments, or a point spread
+        that doesn't span a plane (second eigenvalue below minRatio times the
+        largest). mu and normals of invalid segments are NaN. '''
+    counts, mu, cov = segmentMoments(xyz, labels, nSegments)
+
+    valid = (counts >= minPoints) & np.all(np.isfinite(cov.reshape(nSegments, 9)), axis=1)
+    normals = np.empty((nSegments, 3))
+    normals.fill(np.nan)
+
+    if np.any(valid):
+        # eigenvalues come back in ascending order, so column 0 is the normal
+        e, vecs = np.linalg.eigh(cov[valid])
+        planar = e[:,1] > minRatio * np.maximum(e[:,2], np.finfo(np.float64).tiny)
+
+        n = vecs[:,:,0]
+        n[n[:,2] > 0] *= -1
+        n[~planar] = np.nan
+        normals[valid] = n
+
+        valid[np.flatnonzero(valid)[~planar]] = False
+
+    mu[~valid] = np.nan
+    return mu, normals, valid
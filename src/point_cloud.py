@@ -5,6 +5,9 @@
 import ctypes
 import math
 import struct
+import sys
+
+import numpy as np
 
 #import rosbag
 from sensor_msgs.msg import PointCloud2, PointField
@@ -19,6 +22,20 @@ _DATATYPES[PointField.UINT32]  = ('I', 4)
 _DATATYPES[PointField.FLOAT32] = ('f', 4)
 _DATATYPES[PointField.FLOAT64] = ('d', 8)
 
+_NP_DATATYPES = {}
+_NP_DATATYPES[PointField.INT8]    = np.int8
+_NP_DATATYPES[PointField.UINT8]   = np.uint8
+_NP_DATATYPES[PointField.INT16]   = np.int16
+_NP_DATATYPES[PointField.UINT16]  = np.uint16
+_NP_DATATYPES[PointField.INT32]   = np.int32
+_NP_DATATYPES[PointField.UINT32]  = np.uint32
+_NP_DATATYPES[PointField.FLOAT32] = np.float32
+_NP_DATATYPES[PointField.FLOAT64] = np.float64
+
+_XYZ32_FIELDS = [PointField('x', 0, PointField.FLOAT32, 1),
+                 PointField('y', 4, PointField.FLOAT32, 1),
+                 PointField('z', 8, PointField.FLOAT32, 1)]
+
 def read_points(cloud, field_names=None, skip_nans=False, uvs=[]):
     assert(cloud)
     fmt = _get_struct_fmt(cloud, field_names)
@@ -61,23 +78,11 @@ def read_points(cloud, field_names=None, skip_nans=False, uvs=[]):
                     offset += point_step
 
 def create_cloud_xyz32(header, points):
-    fields = [PointField('x', 0, PointField.FLOAT32, 1),
-              PointField('y', 4, PointField.FLOAT32, 1),
-              PointField('z', 8, PointField.FLOAT32, 1)]
-    return create_cloud(header, fields, points)
+    return create_cloud(header, _XYZ32_FIELDS, points)
 
 def create_cloud(header, fields, points):
-    cloud = PointCloud2()
-    cloud.header       = header
-    cloud.height       = 1
-    cloud.width        = len(points)
-    cloud.is_dense     = False
-    cloud.is_bigendian = False
-    cloud.fields       = fields
-    fmt                = _get_struct_fmt(cloud)
-    cloud_struct       = struct.Struct(fmt)
-    cloud.point_step   = cloud_struct.size
-    cloud.row_step     = cloud_struct.size * cloud.width
+    cloud = _make_cloud(header, fields, len(points))
+    cloud_struct = struct.Struct(_get_struct_fmt(cloud))
 
     buffer = ctypes.create_string_buffer(cloud_struct.size * cloud.width)
 
@@ -91,6 +96,78 @@ def create_cloud(header, fields, points):
 
     return cloud
 
+def read_points_array(cloud, field_names=None, skip_nans=False):
+    ''' Vectorized counterpart of read_points. Returns a read-only structured
+        array of shape (height, width) viewing cloud.data directly; no copy is
+        made unless skip_nans is set, in which case a flat array of the
+        finite points is returned. '''
+    assert(cloud)
+    points = np.ndarray(shape=(cloud.height, cloud.width), dtype=_get_dtype(cloud, field_names),
+                        buffer=cloud.data, strides=(cloud.row_step, cloud.point_step))
+    points.flags.writeable = False
+
+    if skip_nans:
+        valid = np.ones(points.shape, dtype=bool)
+        for name in points.dtype.names:
+            field = points[name]
+            if field.dtype.kind == 'f':
+                valid &= np.isfinite(field) if field.ndim == 2 else np.isfinite(field).all(axis=-1)
+        points = points[valid]
+    return points
+
+def create_cloud_xyz32_array(header, points):
+    ''' Vectorized counterpart of create_cloud_xyz32 for an (N,3) array. '''
+    points = np.ascontiguousarray(points, dtype='<f4').reshape(-1, 3)
+    cloud = _make_cloud(header, _XYZ32_FIELDS, len(points))
+    cloud.data = points.tostring()
+    return cloud
+
+def create_cloud_array(header, fields, points):
+    ''' Vectorized counterpart of create_cloud. points is either a structured
+        array with the field names, or a plain (N, len(fields)) array. '''
+    points = np.asarray(points)
+    cloud = _make_cloud(header, fields, len(points))
+    dtype = _get_dtype(cloud)
+    if points.dtype.names is None:
+        points = points.reshape(len(points), -1)
+        data = np.zeros(len(points), dtype=dtype)
+        for i, name in enumerate(dtype.names):
+            data[name] = points[:, i]
+    else:
+        data = np.zeros(len(points), dtype=dtype)
+        for name in dtype.names:
+            data[name] = points[name]
+    cloud.data = data.tostring()
+    return cloud
+
+def _make_cloud(header, fields, n):
+    cloud = PointCloud2()
+    cloud.header       = header
+    cloud.height       = 1
+    cloud.width        = n
+    cloud.is_dense     = False
+    cloud.is_bigendian = False
+    cloud.fields       = fields
+    cloud.point_step   = struct.calcsize(_get_struct_fmt(cloud))
+    cloud.row_step     = cloud.point_step * cloud.width
+    return cloud
+
+def _get_dtype(cloud, field_names=None):
+    byteorder = '>' if cloud.is_bigendian else '<'
+
+    names, formats, offsets = [], [], []
+    for field in (f for f in sorted(cloud.fields, key=lambda f: f.offset) if field_names is None or f.name in field_names):
+        if field.datatype not in _NP_DATATYPES:
+            print >> sys.stderr, 'Skipping unknown PointField datatype [%d]' % field.datatype
+            continue
+        fmt = np.dtype(_NP_DATATYPES[field.datatype]).newbyteorder(byteorder)
+        names.append(field.name)
+        formats.append(fmt if field.count == 1 else (fmt, field.count))
+        offsets.append(field.offset)
+
+    itemsize = cloud.point_step or struct.calcsize(_get_struct_fmt(cloud))
+    return np.dtype({'names': names, 'formats': formats, 'offsets': offsets, 'itemsize': itemsize})
+
 def _get_struct_fmt(cloud, field_names=None):
     fmt = '>' if cloud.is_bigendian else '<'
 
@@ -0,0 +1,104 @@
+''' Lightweight per-stage timing for the gaze pipeline.
+
+    Every named stage keeps its last `window` durations, from which rolling
+    percentiles are computed on demand. Recording a sample is a deque append,
+    so it is cheap enough to leave on in production; creating a stage takes a
+    lock, so it is safe to call from several threads.
+'''
+import json
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+class Profiler:
+    def __init__(self, window=1000):
+        self.window = window
+        self.stages = {}
+        self.order = []
+        self.lock = threading.Lock()
+
+    def add(self, name, seconds):
+        samples = self.stages.get(name)
+        if samples is None:
+            self.lock.acquire()
+            try:
+                # another thread may have created it since the check above
+                samples = self.stages.get(name)
+                if samples is None:
+                    samples = self.stages[name] = deque(maxlen=self.window)
+                    self.order.append(name)
+            finally:
+                self.lock.release()
+        samples.append(seconds)
+
+    def stage(self, name):
+        ''' Context manager timing the enclosed block as stage name. '''
+        return _Stage(self, name)
+
+    def mean(self, name):
+        samples = self.stages.get(name)
+        if not samples:
+            return 0.0
+        return float(np.mean(list(samples)))
+
+    def summary(self):
+        ''' [(stage, {count, mean, p50, p95, p99, max})] in milliseconds, for
+            the samples currently in the window, in the order the stages were
+            first recorded. '''
+        stats = []
+        for name in list(self.order):
+            samples = np.array(list(self.stages[name])) * 1000.0
+            if len(samples) == 0:
+                continue
+            p50, p95, p99 = np.percentile(samples, [50, 95, 99])
+            stats.append((name, {'count': len(samples),
+                                 'mean': float(np.mean(samples)),
+                                 'p50': float(p50),
+                                 'p95': float(p95),
+                                 'p99': float(p99),
+                                 'max': float(np.max(samples))}))
+        return stats
+
+    def report(self):
+        lines = ['%-24s %6s %8s %8s %8s %8s' % ('stage (ms)', 'n', 'mean', 'p50', 'p95', 'p99')]
+        for name, s in self.summary():
+            lines.append('%-24s %6d %8.2f %8.2f %8.2f %8.2f' % (name, s['count'], s['mean'], s['p50'], s['p95'], s['p99']))
+        return '\n'.join(lines)
+
+    def dump(self, path):
+        f = open(path, 'w')
+        json.dump([{'stage': name, 'ms': s} for name, s in self.summary()], f, indent=2)
+        f.close()
+
+class _Stage:
+    def __init__(self, profiler, name):
+        self.profiler, self.name = profiler, name
+
+    def __enter__(self):
+        self.st = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.add(self.name, time.time() - self.st)
+        return False
+
+class _Laps:
+    def __init__(self, profiler, prefix, verbose):
+        self.profiler, self.prefix, self.verbose = profiler, prefix, verbose
+        self.st = time.time()
+
+    def lap(self, name):
+        now = time.time()
+        if self.profiler is not None:
+            self.profiler.add(self.prefix + name, now - self.st)
+        if self.verbose:
+            print self.prefix + name, now - self.st
+        self.st = now
+
+def laps(profiler, prefix='', verbose=False):
+    ''' Timer whose lap(name) records the time since the previous lap (or
+        since it was created) as stage prefix + name. profiler may be None,
+        for functions whose profiling is optional. '''
+    return _Laps(profiler, prefix, verbose)
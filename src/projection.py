@@ -0,0 +1,114 @@
+''' Depth image to XYZ projection through a per-pixel ray table.
+
+    For a pinhole camera the x and y of a pixel are its depth times a factor
+    that only depends on the pixel and the intrinsics. The factors (scaled
+    from depth units to metres) are computed once per resolution and
+    intrinsics, after which projecting a box is a slice and a multiply.
+'''
+import numpy as np
+
+""" Kinect depth camera intrinsics, as used by Gaze.makeCloud_correct """
+FX = FY = 575.8157348632812
+CX, CY = 314.5, 235.5
+
+class RayTable:
+    ''' float32 x/z and y/z for every pixel of a width x height image, in
+        metres per depth unit. '''
+    def __init__(self, width=640, height=480, fx=FX, fy=FY, cx=CX, cy=CY, scale=0.001):
+        self.width, self.height = width, height
+        self.scale = scale
+        self.rays = np.empty((height, width, 2), dtype=np.float32)
+        self.rays[:,:,0] = ((np.arange(width) - cx) * (scale / fx))[np.newaxis,:]
+        self.rays[:,:,1] = ((np.arange(height) - cy) * (scale / fy))[:,np.newaxis]
+
+    def project(self, depth, box=None, out=None):
+        ''' Organized (rows, cols, 3) cloud of depth, the box (x1, y1, x2, y2)
+            of the full depth image, or all of it without box. out is an
+            optional float32 buffer of that shape to write into. '''
+        if box is None:
+            box = (0, 0, self.width, self.height)
+        x1, y1, x2, y2 = box
+        d = depth[y1:y2,x1:x2]
+        if out is None:
+            out = np.empty(d.shape + (3,), dtype=np.float32)
+        np.multiply(self.rays[y1:y2,x1:x2], d[:,:,np.newaxis], out[:,:,:2])
+        np.multiply(d, self.scale, out[:,:,2])
+        return out
+
+    def projectPoints(self, u, v, d, out=None):
+        ''' (n, 3) cloud of the points at rows u, columns v with depths d. '''
+        d = np.asarray(d)
+        if out is None:
+            out = np.empty((len(d), 3), dtype=np.float32)
+        np.multiply(self.rays[u, v], d[:,np.newaxis], out[:,:2])
+        np.multiply(d, self.scale, out[:,2])
+        return out
+
+_tables = {}
+
+def rayTable(width=640, height=480, fx=FX, fy=FY, cx=CX, cy=CY, scale=0.001):
+    ''' Shared RayTable for these intrinsics, built on first use. '''
+    key = (width, height, fx, fy, cx, cy, scale)
+    if key not in _tables:
+        _tables[key] = RayTable(*key)
+    return _tables[key]
+
+def rayTableFromCameraInfo(info, scale=0.001):
+    ''' Shared RayTable for the intrinsics (K) of a sensor_msgs/CameraInfo. '''
+    K = info.K
+    return rayTable(info.width, info.height, K[0], K[4], K[2], K[5], scale)
+
+class OrganizedCloud:
+    ''' Organized (height, width, 3) float32 cloud of one depth frame with a
+        validity mask, projected lazily: only the pixels of boxes asked for
+        are ever computed, and rows of a box that earlier boxes of the frame
+        already covered are not projected again. '''
+    def __init__(self, rays):
+        self.rays = rays
+        self.xyz = np.empty((rays.height, rays.width, 3), dtype=np.float32)
+        self.valid = np.zeros((rays.height, rays.width), dtype=bool)
+        self.computed = np.zeros((rays.height, rays.width), dtype=bool)
+        self.depth = None
+        self.dirty = []
+
+    def reset(self, depth):
+        ''' Start a new frame. Only the parts computed for the last one are
+            cleared. '''
+        for x1, y1, x2, y2 in self.dirty:
+            self.computed[y1:y2,x1:x2] = False
+        self.dirty = []
+        self.depth = depth
+
+    def clip(self, box):
+        x1, y1, x2, y2 = [int(round(c)) for c in box]
+        return (min(max(x1, 0), self.rays.width), min(max(y1, 0), self.rays.height),
+                min(max(x2, 0), self.rays.width), min(max(y2, 0), self.rays.height))
+
+    def view(self, box):
+        ''' (xyz, valid) views of box, (x1, y1, x2, y2) clipped to the frame. '''
+        x1, y1, x2, y2 = box = self.clip(box)
+        todo = np.flatnonzero(~self.computed[y1:y2,x1:x2].all(axis=1))
+        if len(todo):
+            """ Project the rows of the box that still have missing pixels """
+            r1, r2 = y1 + todo[0], y1 + todo[-1] + 1
+            d = self.depth[r1:r2,x1:x2]
+            self.rays.project(self.depth, (x1, r1, x2, r2), self.xyz[r1:r2,x1:x2])
+            valid = self.valid[r1:r2,x1:x2]
+            np.not_equal(d, 0, valid)
+            if d.dtype.kind == 'f':
+                valid &= np.isfinite(d)
+            self.computed[r1:r2,x1:x2] = True
+            self.dirty.append((x1, r1, x2, r2))
+        return self.xyz[y1:y2,x1:x2], self.valid[y1:y2,x1:x2]
+
+    def indices(self, box):
+        ''' Flat indices (into xyz.reshape(-1, 3)) of the valid points of box. '''
+        x1, y1, x2, y2 = box = self.clip(box)
+        xyz, valid = self.view(box)
+        rows, cols = np.nonzero(valid)
+        return (rows + y1) * self.rays.width + cols + x1
+
+    def points(self, indices):
+        ''' (n, 3) copy of the points at indices, e.g. the concatenated
+            indices of several boxes. '''
+        return self.xyz.reshape(-1, 3)[indices]
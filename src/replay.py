@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+''' Headless replay of recorded depth frames through the gaze feature
+    pipeline, one batch per worker process.
+
+    python replay.py -o features/ 1=rec/batch1 2=rec/batch2.dat ...
+
+    Each recording is either a file holding one or more pickled depth frames
+    (like It_depth.dat) or a directory of such files, replayed in name order.
+    batchN_features.dat (or with --binary, a batchN_features.gzf feature store)
+    is written to the output directory for every batch.
+'''
+import os
+import sys
+import pickle
+import time
+from multiprocessing import Pool
+from optparse import OptionParser
+
+import numpy as np
+
+from dxySegment import dxySegmentSparse
+from features import PEOPLE_PER_BATCH, faceDescriptors, featureRow
+from featurestore import FeatureWriter
+
+def loadFrames(path):
+    ''' Yield the depth frames of a recording, one at a time. '''
+    if os.path.isdir(path):
+        for name in sorted(os.listdir(path)):
+            for frame in loadFrames(os.path.join(path, name)):
+                yield frame
+        return
+
+    f = open(path, 'rb')
+    try:
+        while True:
+            try:
+                frame = pickle.load(f)
+            except EOFError:
+                break
+            yield np.asarray(frame)
+    finally:
+        f.close()
+
+def replayBatch(frames, featureFile, nClusters, engine='histogram'):
+    ''' Run frames through the same steps as Gaze.process_frame: segment
+        with seeds carried over from the previous frame, then crop, resize
+        and write one feature row per face, to a text file or a
+        FeatureWriter. A frame nobody is near enough in is skipped, and the
+        next one starts from the same seeds. Returns the number of frames. '''
+    binary = isinstance(featureFile, FeatureWriter)
+    descriptors = np.empty((nClusters, 400), dtype=np.uint16)
+    seeds = None
+    nFrames = 0
+    for np_depth in frames:
+        if seeds is None:
+            faces, seeds, labels = dxySegmentSparse(np_depth, nClusters=nClusters, skip=1, engine=engine)
+        else:
+            faces, seeds, labels = dxySegmentSparse(np_depth, seeds=seeds, skip=1, engine=engine)
+        if len(faces) == 0:
+            print >>sys.stderr, 'frame %d: no depth in the near band, skipped' % nFrames
+            nFrames += 1
+            continue
+
+        if len(faces) > len(descriptors):
+            descriptors = np.empty((len(faces), 400), dtype=np.uint16)
+        faceDescs = faceDescriptors(np_depth, sorted(faces), out=descriptors[:len(faces)])
+        if binary:
+            featureFile.writeFaces(faceDescs, frame=nFrames)
+        else:
+            for faceNum, desc in enumerate(faceDescs):
+                featureFile.write(featureRow(faceNum+1, desc))
+        nFrames += 1
+    return nFrames
+
+def _replayJob(job):
+    batch, path, outDir, engine, binary = job
+    st = time.time()
+    if binary:
+        fw = FeatureWriter(os.path.join(outDir, 'batch%d_features.gzf' % batch), batch)
+    else:
+        fw = open(os.path.join(outDir, 'batch%d_features.dat' % batch), 'w')
+    try:
+        nFrames = replayBatch(loadFrames(path), fw, PEOPLE_PER_BATCH[batch-1], engine)
+    finally:
+        fw.close()
+    return batch, nFrames, time.time() - st
+
+def replayAll(recordings, outDir, processes=None, engine='histogram', binary=False):
+    ''' Replay {batch number: recording path} in parallel. Batches are
+        independent, frames within a batch are processed in order. '''
+    jobs = [(batch, path, outDir, engine, binary) for batch, path in sorted(recordings.items())]
+    pool = Pool(processes)
+    try:
+        results = pool.map(_replayJob, jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    return results
+
+def main(args):
+    parser = OptionParser(usage="%prog [options] [BATCH=]RECORDING ...")
+    parser.add_option("-o", "--output", default=".", help="directory for batchN_features.dat")
+    parser.add_option("-j", "--jobs", type="int", default=None, help="worker processes (default: one per core)")
+    parser.add_option("--engine", default="histogram", help="dxySegment clustering engine")
+    parser.add_option("--binary", action="store_true", default=False, help="write batchN_features.gzf feature stores instead of text")
+    options, args = parser.parse_args(args)
+    if not args:
+        parser.error("no recordings given")
+
+    recordings = {}
+    for i, arg in enumerate(args):
+        if '=' in arg:
+            batch, path = arg.split('=', 1)
+            recordings[int(batch)] = path
+        else:
+            recordings[i+1] = arg
+
+    if not os.path.isdir(options.output):
+        os.makedirs(options.output)
+
+    st = time.time()
+    for batch, nFrames, duration in replayAll(recordings, options.output, options.jobs, options.engine, options.binary):
+        print 'batch %d: %d frames in %.1f s (%.1f fps)' % (batch, nFrames, duration, nFrames / max(duration, 1e-9))
+    print 'total time', time.time() - st
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+''' Offline replay of the bundled depth fixtures and of synthetic recordings.
+
+    python -m unittest test_replay
+'''
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from dxySegment import dxySegmentSparse
+from features import faceDescriptors, featureRow
+from featurestore import readStore, FeatureWriter
+from replay import loadFrames, replayAll, replayBatch
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+def nearFrame():
+    ''' A frame with two people in the near band in front of a far wall. '''
+    d = np.zeros((480, 640), dtype=np.uint16)
+    d[40:440,:] = 8000
+    d[100:300,100:180] = 1500
+    d[120:320,400:480] = 1600
+    return d
+
+def groupFrame(shift=0):
+    ''' Four people, as in batch 2, well apart in depth or side by side,
+        so that the clustering has one clear answer. '''
+    d = np.zeros((480, 640), dtype=np.uint16)
+    d[40:440,:] = 8000
+    rows, cols = np.mgrid[0:180,0:70]
+    for i, (x, y, z) in enumerate([(40, 100, 1500), (200, 120, 1700), (360, 90, 1600), (520, 110, 1800)]):
+        d[y+shift:y+shift+180,x:x+70] = z + rows + 2*cols + 50*i
+    d[150:160,60:70] = 0 # a hole, left out of the cell averages
+    return d
+
+def writeRecording(path, frames):
+    f = open(path, 'wb')
+    for frame in frames:
+        pickle.dump(frame, f, pickle.HIGHEST_PROTOCOL)
+    f.close()
+
+def expectedDescriptors(frames, nClusters):
+    ''' Descriptors of every frame, computed directly on the segmentation
+        the replay carries seeds through. '''
+    seeds, rows = None, []
+    for frame in frames:
+        if seeds is None:
+            faces, seeds, labels = dxySegmentSparse(frame, nClusters=nClusters, skip=1, engine='histogram')
+        else:
+            faces, seeds, labels = dxySegmentSparse(frame, seeds=seeds, skip=1, engine='histogram')
+        rows.append(faceDescriptors(frame, sorted(faces)))
+    return rows
+
+class ReplayTest(unittest.TestCase):
+    def setUp(self):
+        self.outDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.outDir)
+
+    def testFixtures(self):
+        ''' No fixture pixel is in the near band; every frame is skipped
+            instead of failing the batch. '''
+        recordings = {1: os.path.join(HERE, 'It_depth.dat'), 2: os.path.join(HERE, 'It2_depth.dat')}
+        results = replayAll(recordings, self.outDir, processes=2)
+        self.assertEqual([(batch, nFrames) for batch, nFrames, duration in results], [(1, 1), (2, 1)])
+        for batch in recordings:
+            self.assertTrue(os.path.exists(os.path.join(self.outDir, 'batch%d_features.dat' % batch)))
+
+    def testFaceFixture(self):
+        ''' Rows written for a recording with faces are the descriptors of
+            its face boxes, in the text and the binary format. '''
+        frames = [groupFrame(shift) for shift in (0, 2, 4)]
+        recording = os.path.join(self.outDir, 'faces.dat')
+        writeRecording(recording, frames)
+        self.assertEqual(len(list(loadFrames(recording))), 3)
+        # the clustering starts from random seeds; seed both runs the same
+        np.random.seed(0)
+        perFrame = expectedDescriptors(frames, 4) # batch 2 has 4 people
+        self.assertEqual([len(rows) for rows in perFrame], [4, 4, 4])
+        expected = np.vstack(perFrame)
+        self.assertTrue((expected > 0).all(axis=1).any())
+        faceNums = [n+1 for rows in perFrame for n in range(len(rows))]
+        frameNums = [i for i, rows in enumerate(perFrame) for n in range(len(rows))]
+
+        path = os.path.join(self.outDir, 'batch2_features.dat')
+        f = open(path, 'w')
+        np.random.seed(0)
+        self.assertEqual(replayBatch(loadFrames(recording), f, 4), 3)
+        f.close()
+        self.assertEqual(open(path).readlines(), [featureRow(n, desc) for n, desc in zip(faceNums, expected)])
+
+        path = os.path.join(self.outDir, 'batch2_features.gzf')
+        writer = FeatureWriter(path, 2)
+        np.random.seed(0)
+        self.assertEqual(replayBatch(loadFrames(recording), writer, 4), 3)
+        writer.close()
+        store = readStore(path)
+        self.assertEqual(list(store['batch']), [2] * len(expected))
+        self.assertEqual(list(store['frame']), frameNums)
+        self.assertEqual(list(store['face']), faceNums)
+        self.assertTrue((store['features'] == expected).all())
+
+    def testSeedsKept(self):
+        faces, seeds, labels = dxySegmentSparse(nearFrame(), nClusters=2, skip=1)
+        self.assertEqual(len(faces), 2)
+        empty = np.full((480, 640), 3000, dtype=np.uint16)
+        for engine in ['kmeans2', 'histogram']:
+            faces, kept, labels = dxySegmentSparse(empty, seeds=seeds, skip=1, engine=engine)
+            self.assertEqual(faces, [])
+            self.assertTrue(kept is seeds)
+            self.assertTrue((labels == -1).all())
+
+    def testSkippedFrame(self):
+        ''' Frames around an empty one are still written. '''
+        frames = [nearFrame(), np.full((480, 640), 3000, dtype=np.uint16), nearFrame()]
+        path = os.path.join(self.outDir, 'features.dat')
+        f = open(path, 'w')
+        try:
+            self.assertEqual(replayBatch(frames, f, 2), 3)
+        finally:
+            f.close()
+        self.assertEqual(len(open(path).readlines()), 4)
+
+if __name__ == '__main__':
+    unittest.main()